@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Reads per second of the local caches by number of threads
+
+    python bench_local_cache.py [seconds per run] [load ms]
+
+``LocalCache`` is not thread safe, ``GlobalLockLocalCache`` is the
+naive fix, one lock around every read, held while loading too.  Names
+expire quickly so that some reads load, ``get_data`` sleeps like the
+database query it usually is.
+"""
+
+import sys
+import time
+import random
+import threading
+
+from local_cache import LocalCache, ConcurrentLocalCache
+
+NAMES = 1000
+THREADS = (1, 2, 4, 8, 16)
+
+
+class BenchMixin(object):
+    __slots__ = ()
+    cache_time = 1.0
+    load_seconds = 0.0005
+
+    def get_data(self, name):
+        time.sleep(self.load_seconds)
+        return name
+
+
+class BenchLocalCache(BenchMixin, LocalCache):
+    __slots__ = ()
+
+
+class GlobalLockLocalCache(BenchMixin, LocalCache):
+    __slots__ = ('__global_lock__',)
+
+    def __init__(self):
+        super(GlobalLockLocalCache, self).__init__()
+        object.__setattr__(self, '__global_lock__', threading.Lock())
+
+    def __getattr__(self, name):
+        with self.__global_lock__:
+            return LocalCache.__getattr__(self, name)
+
+
+class BenchConcurrentLocalCache(BenchMixin, ConcurrentLocalCache):
+    __slots__ = ()
+
+
+CACHES = [
+    ('LocalCache', BenchLocalCache),
+    ('GlobalLock', GlobalLockLocalCache),
+    ('Concurrent', BenchConcurrentLocalCache),
+]
+
+
+def run(cache, n_threads, seconds):
+    counts = [0] * n_threads
+    stop = threading.Event()
+
+    def reader(i):
+        rnd = random.Random(i)
+        names = [rnd.randrange(NAMES) for _ in xrange(1000)]
+        n = 0
+        while not stop.is_set():
+            for name in names:
+                cache[name]
+            n += len(names)
+        counts[i] = n
+
+    threads = [threading.Thread(target=reader, args=(i,))
+               for i in xrange(n_threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / (time.time() - start)
+
+
+def main(seconds=2.0, load_ms=0.5):
+    BenchMixin.load_seconds = load_ms / 1000.0
+    print '%-12s' % 'threads' + ''.join('%12d' % n for n in THREADS)
+    for name, cache_cls in CACHES:
+        rates = []
+        for n_threads in THREADS:
+            cache = cache_cls()
+            for i in xrange(NAMES):
+                cache[i]
+            rates.append(run(cache, n_threads, seconds))
+        print '%-12s' % name + ''.join('%12.0f' % r for r in rates)
+
+
+if __name__ == '__main__':
+    main(*[float(a) for a in sys.argv[1:3]])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Lookups per second and load skew of every registered hash function on
+every ring class
+
+    python bench_hash.py [nodes] [keys]
+"""
+
+import sys
+import math
+import time
+
+from hashfuncs import HASH_FUNCTIONS
+from hashring import HashRing
+from consistent_hash import YHash
+from memecache_hash import HashConsistency
+
+RINGS = [
+    ('HashRing', lambda nodes, hash_fn: HashRing(nodes, hash_fn=hash_fn)),
+    ('YHash', lambda nodes, hash_fn: YHash(nodes, 40, hash_fn=hash_fn)),
+    ('HashConsistency',
+     lambda nodes, hash_fn: HashConsistency(nodes, 40, hash_fn=hash_fn)),
+]
+
+
+def load_skew(nodes, owners):
+    """(max load / mean load, stddev / mean) of keys per node"""
+    loads = dict((n, 0) for n in nodes)
+    for owner in owners:
+        loads[owner] += 1
+    mean = float(len(owners)) / len(nodes)
+    var = sum((l - mean) ** 2 for l in loads.itervalues()) / len(nodes)
+    return max(loads.itervalues()) / mean, math.sqrt(var) / mean
+
+
+def _owner(node):
+    # HashConsistency.get_node returns (hash, node)
+    return node[1] if isinstance(node, tuple) else node
+
+
+def bench(ring_name, make_ring, hash_fn, nodes, keys):
+    ring = make_ring(nodes, hash_fn)
+    get_node = ring.get_node
+    start = time.time()
+    owners = [_owner(get_node(k)) for k in keys]
+    elapsed = time.time() - start
+    max_ratio, cv = load_skew(nodes, owners)
+    return {
+        'ring': ring_name,
+        'hash_fn': hash_fn,
+        'lookups_per_sec': len(keys) / elapsed,
+        'max_load_ratio': max_ratio,
+        'load_cv': cv,
+    }
+
+
+def main(n_nodes=16, n_keys=100000):
+    nodes = ['10.0.%d.%d' % (i // 256, i % 256) for i in xrange(n_nodes)]
+    keys = ['key_%s' % i for i in xrange(n_keys)]
+    print '%-16s %-10s %14s %10s %8s' % (
+        'ring', 'hash_fn', 'lookups/s', 'max/mean', 'cv')
+    for ring_name, make_ring in RINGS:
+        for hash_fn in sorted(HASH_FUNCTIONS):
+            r = bench(ring_name, make_ring, hash_fn, nodes, keys)
+            print '%-16s %-10s %14.0f %10.3f %8.3f' % (
+                r['ring'], r['hash_fn'], r['lookups_per_sec'],
+                r['max_load_ratio'], r['load_cv'])
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
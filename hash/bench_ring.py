@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark and balance report of every ring, as JSON
+
+    python bench_ring.py --nodes 16 --keys 10000 100000 1000000 -o out.json
+
+for each ring and key count it reports build time, lookups per second,
+memory per ring point, keys per node (stddev and max / mean) and the
+share of keys moving when a node is added or removed.
+"""
+
+import sys
+import gc
+import json
+import time
+import argparse
+from array import array
+
+from bench_hash import load_skew
+from ring import RING_ENGINES
+from memecache_hash import HashConsistency
+
+RINGS = dict(RING_ENGINES, memcache=HashConsistency)
+
+
+def deep_sizeof(obj, seen=None):
+    """approximate bytes held by ``obj`` and everything it references,
+    shared strings and ints are counted once
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif isinstance(obj, (basestring, int, long, float, array)):
+        pass
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def ring_points(ring):
+    for attr in ('_points', '_sort_list', 'nodes_map', '_table'):
+        if hasattr(ring, attr):
+            return len(getattr(ring, attr))
+    return len(ring.nodes)
+
+
+def lookup_all(ring, keys):
+    if hasattr(ring, 'get_nodes'):
+        return ring.get_nodes(keys)
+    # HashConsistency.get_node returns (hash, node)
+    return [ring.get_node(k)[1] for k in keys]
+
+
+def moved_share(before, after):
+    return sum(1 for a, b in zip(before, after) if a != b) / float(len(before))
+
+
+def bench(engine, nodes, keys):
+    ring_cls = RINGS[engine]
+    gc.collect()
+    start = time.time()
+    ring = ring_cls(list(nodes))
+    build_time = time.time() - start
+
+    start = time.time()
+    owners = lookup_all(ring, keys)
+    lookup_time = time.time() - start
+
+    points = ring_points(ring)
+    max_ratio, cv = load_skew(nodes, owners)
+    mean = float(len(keys)) / len(nodes)
+
+    new_node = '10.255.255.255'
+    ring.add_node(new_node)
+    moved_on_add = moved_share(owners, lookup_all(ring, keys))
+    ring.remove_node(new_node)
+    ring.remove_node(nodes[0])
+    moved_on_remove = moved_share(owners, lookup_all(ring, keys))
+
+    return {
+        'engine': engine,
+        'nodes': len(nodes),
+        'keys': len(keys),
+        'build_seconds': build_time,
+        'lookups_per_second': len(keys) / lookup_time,
+        'points': points,
+        'bytes_per_point': deep_sizeof(ring_cls(list(nodes))) / float(points),
+        'load_stddev': cv * mean,
+        'load_max_ratio': max_ratio,
+        'moved_on_add': moved_on_add,
+        'moved_on_remove': moved_on_remove,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nodes', type=int, default=16)
+    parser.add_argument('--keys', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--engines', nargs='+', default=sorted(RINGS),
+                        choices=sorted(RINGS))
+    parser.add_argument('-o', '--output', help='JSON file, default stdout')
+    args = parser.parse_args(argv)
+
+    nodes = ['10.0.%d.%d' % (i // 256, i % 256) for i in xrange(args.nodes)]
+    results = []
+    for n_keys in args.keys:
+        keys = ['key_%s' % i for i in xrange(n_keys)]
+        for engine in args.engines:
+            results.append(bench(engine, nodes, keys))
+
+    report = {
+        'python': sys.version.split()[0],
+        'time': int(time.time()),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
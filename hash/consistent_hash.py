@@ -1,15 +1,28 @@
 # -*- coding: utf-8 -*-
 
-import hashlib
+from bisect import bisect_left
+
+from hashfuncs import get_hash
+from route_cache import RouteCache, MISSING
 
 
 class YHash(object):
-    def __init__(self, nodes=None, n_number=3):
+    def __init__(self, nodes=None, n_number=3, hash_fn='md5_128',
+                 route_cache_size=0):
         """
         :param nodes:     all nodes
         :param n_number:  v_nodes per node
+        :param hash_fn:   name of a function in :mod:`hashfuncs`
+        :param route_cache_size:  keys kept in a LRU key -> node cache,
+                                  dropped on every add / remove
         """
         self._n_number = n_number
+        self.hash_fn = hash_fn
+        self._gen_key = get_hash(hash_fn)[0]
+        self.epoch = 0
+        self.route_cache = None
+        if route_cache_size:
+            self.route_cache = RouteCache(route_cache_size)
         self._node_dict = dict()
         self._sort_list = []
         self.nodes = nodes
@@ -20,6 +33,7 @@ class YHash(object):
     def add_node(self, node):
         self._add_nodes_map(node)
         self._sort_list.sort()
+        self.epoch += 1
 
     def _add_nodes_map(self, node):
         for i in xrange(self._n_number):
@@ -34,30 +48,56 @@ class YHash(object):
             key = self._gen_key(node_str)
             del self._node_dict[key]
             self._sort_list.remove(key)
+        self.epoch += 1
 
     def get_node(self, key_str):
-        if self._sort_list:
-            key = self._gen_key(key_str)
-            for node_key in self._sort_list:
-                if key <= node_key:
-                    return self._node_dict[node_key]
-            return self._node_dict[self._sort_list[0]]
-        else:
+        """return the node of the first v_node whose key >= hash of
+        ``key_str``, wrap around to the first v_node if none
+        """
+        cache = self.route_cache
+        if cache is not None:
+            node = cache.get(key_str, self.epoch)
+            if node is not MISSING:
+                return node
+        sort_list = self._sort_list
+        if not sort_list:
             return None
+        pos = bisect_left(sort_list, self._gen_key(key_str))
+        if pos == len(sort_list):
+            pos = 0
+        node = self._node_dict[sort_list[pos]]
+        if cache is not None:
+            cache.put(key_str, node)
+        return node
 
-    @staticmethod
-    def _gen_key(key_str):
-        md5_str = hashlib.md5(key_str).hexdigest()
-        return long(md5_str, 16)
+    def get_nodes(self, keys):
+        """batched :meth:`get_node`, return nodes in the same order of
+        ``keys``
+        """
+        if self.route_cache is not None:
+            return [self.get_node(k) for k in keys]
+        sort_list = self._sort_list
+        if not sort_list:
+            return [None] * len(keys)
+        node_dict = self._node_dict
+        gen_key = self._gen_key
+        size = len(sort_list)
+        # resolve every v_node position to its node once, so each key
+        # costs one md5 and one bisect only
+        pos_nodes = [node_dict[k] for k in sort_list]
+        pos_nodes.append(pos_nodes[0])
+        return [pos_nodes[bisect_left(sort_list, gen_key(k), 0, size)]
+                for k in keys]
 
     def _sort_nodes(self):
         self._sort_list = sorted(self._sort_list, key=lambda x: x[0])
 
 
-nodes = ['192.168.0.1', '192.168.0.2']
+if __name__ == '__main__':
+    nodes = ['192.168.0.1', '192.168.0.2']
 
-h = YHash(nodes)
-for i in xrange(10):
-    key = 'test_%s' % i
-    server = h.get_node(key)
-    print key, '===>', server
+    h = YHash(nodes)
+    for i in xrange(10):
+        key = 'test_%s' % i
+        server = h.get_node(key)
+        print key, '===>', server
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Key hash functions shared by the rings
+
+Every function takes a byte string and returns a non negative int no
+larger than the ``max_value`` it was registered with::
+
+    func, max_value = get_hash('crc32')
+"""
+
+import struct
+import hashlib
+from zlib import crc32
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_FUNCTIONS = {}
+
+_KETAMA_WORDS = struct.Struct('<4I')
+_MD5_128 = struct.Struct('>QQ')
+_MD5_64 = struct.Struct('>Q')
+
+_MASK64 = 0xffffffffffffffff
+
+
+def register_hash(name, max_value):
+    def deco(f):
+        HASH_FUNCTIONS[name] = (f, max_value)
+        return f
+    return deco
+
+
+def get_hash(name):
+    try:
+        return HASH_FUNCTIONS[name]
+    except KeyError:
+        raise ValueError('unknown hash function: {!r}'.format(name))
+
+
+def ketama_words(key):
+    """the four little endian 32-bit words of the md5 digest, ketama puts
+    a vnode on each of the first three
+    """
+    return _KETAMA_WORDS.unpack(hashlib.md5(key).digest())
+
+
+@register_hash('md5', 0xffffffff)
+def md5_ketama(key):
+    return ketama_words(key)[0]
+
+
+@register_hash('md5_128', (1 << 128) - 1)
+def md5_128(key):
+    hi, lo = _MD5_128.unpack(hashlib.md5(key).digest())
+    return (hi << 64) | lo
+
+
+@register_hash('crc32', 0xffffffff)
+def crc32_32(key):
+    return crc32(key) & 0xffffffff
+
+
+@register_hash('crc32_abs', 1 << 31)
+def crc32_abs(key):
+    # what ``abs(crc32(key))`` gives on python 2
+    return abs(crc32(key))
+
+
+@register_hash('md5_64', _MASK64)
+def md5_64(key):
+    """the first 64 bits of the md5 digest, always available and hashed
+    in C, unlike ``xxh64`` which needs the ``xxhash`` package
+    """
+    return _MD5_64.unpack_from(hashlib.md5(key).digest())[0]
+
+
+if xxhash is not None:
+    @register_hash('xxh64', _MASK64)
+    def xxh64(key):
+        return xxhash.xxh64(key).intdigest()
@@ -1,118 +1,338 @@
 # -*- coding: utf-8 -*-
 
-import sys
 import math
-from bisect import bisect
+from array import array
+from bisect import bisect, bisect_left
+from itertools import islice
 
-if sys.version_info >= (2, 5):
-    import hashlib
-    md5_constructor = hashlib.md5
-else:
-    import md5
-    md5_constructor = md5.new
+from hashfuncs import get_hash, ketama_words
+from route_cache import RouteCache, MISSING
+
+# pads the preference lists shorter than ``replicas``
+NO_NODE = 0xffffffff
 
 
 class HashRing(object):
-    def __init__(self, nodes=None, weights=None):
-        self.ring = dict()
-        self._sorted_keys = []
-        self.nodes = nodes
+    """ketama style ring
+
+    Points are kept in a compact sorted ``array('I')`` of uint32 with a
+    parallel array of indexes into the node table, so a vnode costs 8
+    bytes and topology changes only splice the points of the nodes whose
+    vnode count changed.
+
+    Every point also keeps its preference list, the first ``replicas``
+    distinct nodes met walking clockwise from it, for
+    :meth:`get_replicas`: ``replicas`` more node indexes per point in a
+    flat ``array('I')``, the list of point ``pos`` starting at
+    ``pos * replicas``.
+
+    ``hash_fn`` names a function of :mod:`hashfuncs`, keys and points are
+    cut to its lower 32 bits.  ``md5`` is the classic ketama ring.
+
+    With ``route_cache_size`` the nodes of the most recently looked up
+    keys are kept in a :class:`route_cache.RouteCache`, dropped whenever
+    ``epoch`` is bumped by a topology change.
+    """
+
+    def __init__(self, nodes=None, weights=None, replicas=3, hash_fn='md5',
+                 route_cache_size=0):
+        self.nodes = list(nodes or [])
+        self.replicas = replicas
+        self.hash_fn = hash_fn
+        self._hash = get_hash(hash_fn)[0]
+        self.epoch = 0
+        self.route_cache = None
+        if route_cache_size:
+            self.route_cache = RouteCache(route_cache_size)
 
         if not weights:
             weights = {}
-        self.weights = weights
+        self.weights = dict(weights)
+
+        # node table, ``None`` marks a free slot left by a removed node
+        self._node_table = []
+        self._node_index = {}
+        # vnode count currently on the ring for each node
+        self._factors = {}
+        self._points = array('I')
+        self._point_nodes = array('I')
+        # preference lists of node indexes, ``replicas`` per point
+        self._prefs = array('I')
 
         self._generate_circle()
 
     def _generate_circle(self):
+        factors = self._gen_factors()
+        pairs = []
+        for node in self.nodes:
+            idx = self._alloc_node(node)
+            factor = factors[node]
+            for key in self._gen_points(node, 0, factor):
+                pairs.append((key, idx))
+            self._factors[node] = factor
+        pairs.sort()
+        self._points = array('I', [p[0] for p in pairs])
+        self._point_nodes = array('I', [p[1] for p in pairs])
+        self._build_prefs()
+
+    def _walk_pref(self, pos):
+        point_nodes = self._point_nodes
+        size = len(point_nodes)
+        pref = []
+        for i in xrange(size):
+            idx = point_nodes[(pos + i) % size]
+            if idx not in pref:
+                pref.append(idx)
+                if len(pref) == self.replicas:
+                    break
+        return tuple(pref)
+
+    def _pref_before(self, idx, pref):
+        """preference list of a point of node ``idx`` followed by a point
+        whose preference list is ``pref``
+        """
+        if idx in pref:
+            return (idx,) + tuple(i for i in pref if i != idx)
+        return (idx,) + pref[:self.replicas - 1]
+
+    def _get_pref(self, pos):
+        r = self.replicas
+        return tuple(idx for idx in self._prefs[pos * r:(pos + 1) * r]
+                     if idx != NO_NODE)
+
+    def _set_pref(self, pos, pref):
+        r = self.replicas
+        self._prefs[pos * r:(pos + 1) * r] = array(
+            'I', pref + (NO_NODE,) * (r - len(pref)))
+
+    def _build_prefs(self):
+        point_nodes = self._point_nodes
+        size = len(point_nodes)
+        self._prefs = array('I', [NO_NODE]) * (size * self.replicas)
+        if not size:
+            return
+        pref = self._walk_pref(size - 1)
+        self._set_pref(size - 1, pref)
+        for pos in xrange(size - 2, -1, -1):
+            pref = self._pref_before(point_nodes[pos], pref)
+            self._set_pref(pos, pref)
+
+    def _update_prefs(self, pos):
+        """fix the preference lists after a point was spliced in or out
+        right before ``pos``, walking counter clockwise until a list is
+        unchanged as all the ones before it depend on it only
+        """
+        point_nodes = self._point_nodes
+        size = len(point_nodes)
+        if not size:
+            return
+        pos %= size
+        pref = self._walk_pref(pos)
+        self._set_pref(pos, pref)
+        for i in xrange(1, size):
+            q = (pos - i) % size
+            pref = self._pref_before(point_nodes[q], pref)
+            if self._get_pref(q) == pref:
+                break
+            self._set_pref(q, pref)
+
+    def _gen_factors(self):
         total_weight = 0
         for node in self.nodes:
             total_weight += self.weights.get(node, 1)
 
+        factors = {}
         for node in self.nodes:
-            weight = 1
+            weight = self.weights.get(node, 1)
+            factors[node] = int(
+                math.floor((40 * len(self.nodes) * weight) / total_weight))
+        return factors
+
+    def _gen_points(self, node, start, stop):
+        if self.hash_fn == 'md5':
+            for j in range(start, stop):
+                words = ketama_words('%s_%s' % (node, j))
+                for i in range(0, 3):
+                    yield words[i]
+        else:
+            hash_ = self._hash
+            for j in range(start, stop):
+                for i in range(0, 3):
+                    yield hash_('%s_%s-%s' % (node, j, i)) & 0xffffffff
 
-            if node in self.weights:
-                weight = self.weights.get(node)
+    def _alloc_node(self, node):
+        try:
+            idx = self._node_table.index(None)
+            self._node_table[idx] = node
+        except ValueError:
+            idx = len(self._node_table)
+            self._node_table.append(node)
+        self._node_index[node] = idx
+        return idx
 
-            factor = math.floor((40 * len(self.nodes) * weight) / total_weight)
+    def _insert_points(self, idx, keys):
+        points = self._points
+        point_nodes = self._point_nodes
+        for key in keys:
+            pos = bisect(points, key)
+            points.insert(pos, key)
+            point_nodes.insert(pos, idx)
+            r = self.replicas
+            self._prefs[pos * r:pos * r] = array('I', [NO_NODE]) * r
+            self._update_prefs(pos)
 
-            for j in range(0, int(factor)):
-                b_key = self._hash_digest('%s_%s' % (node, j))
+    def _remove_points(self, idx, keys):
+        points = self._points
+        point_nodes = self._point_nodes
+        for key in keys:
+            pos = bisect_left(points, key)
+            # skip points of other nodes colliding on the same hash
+            while point_nodes[pos] != idx:
+                pos += 1
+            del points[pos]
+            del point_nodes[pos]
+            del self._prefs[pos * self.replicas:(pos + 1) * self.replicas]
+            self._update_prefs(pos)
 
-                for i in range(0, 3):
-                    key = self._hash_val(b_key, lambda x: x + i * 4)
-                    self.ring[key] = node
-                    self._sorted_keys.append(key)
+    def _rebalance(self):
+        """move every node to its target vnode count, only the vnodes
+        added or dropped are hashed and spliced
+        """
+        factors = self._gen_factors()
+        for node, factor in factors.iteritems():
+            idx = self._node_index[node]
+            old_factor = self._factors.get(node, 0)
+            if factor > old_factor:
+                self._insert_points(
+                    idx, self._gen_points(node, old_factor, factor))
+            elif factor < old_factor:
+                self._remove_points(
+                    idx, self._gen_points(node, factor, old_factor))
+            self._factors[node] = factor
 
-        self._sorted_keys.sort()
+    def add_node(self, node, weight=None):
+        if node in self._node_index:
+            raise ValueError('node %r already in ring' % (node,))
+        if weight is not None:
+            self.weights[node] = weight
+        self.nodes.append(node)
+        self._alloc_node(node)
+        self._rebalance()
+        self.epoch += 1
+
+    def remove_node(self, node):
+        if node not in self._node_index:
+            raise ValueError('node %r not in ring' % (node,))
+        idx = self._node_index.pop(node)
+        self._remove_points(
+            idx, self._gen_points(node, 0, self._factors.pop(node)))
+        self._node_table[idx] = None
+        self.nodes.remove(node)
+        self.weights.pop(node, None)
+        if self.nodes:
+            self._rebalance()
+        self.epoch += 1
+
+    def set_weight(self, node, weight):
+        if node not in self._node_index:
+            raise ValueError('node %r not in ring' % (node,))
+        self.weights[node] = weight
+        self._rebalance()
+        self.epoch += 1
 
     def get_node(self, string_key):
+        cache = self.route_cache
+        if cache is not None:
+            node = cache.get(string_key, self.epoch)
+            if node is not MISSING:
+                return node
         pos = self.get_node_pos(string_key)
         if pos is None:
             return None
-        return self.ring[self._sorted_keys[pos]]
+        node = self._node_table[self._point_nodes[pos]]
+        if cache is not None:
+            cache.put(string_key, node)
+        return node
+
+    def get_nodes(self, keys):
+        points = self._points
+        if not points:
+            return [None] * len(keys)
+        node_table = self._node_table
+        point_nodes = self._point_nodes
+        gen_key = self.gen_key
+        size = len(points)
+        cache = self.route_cache
+        epoch = self.epoch
+        nodes = []
+        for k in keys:
+            if cache is not None:
+                node = cache.get(k, epoch)
+                if node is not MISSING:
+                    nodes.append(node)
+                    continue
+            pos = bisect(points, gen_key(k))
+            if pos == size:
+                pos = 0
+            node = node_table[point_nodes[pos]]
+            if cache is not None:
+                cache.put(k, node)
+            nodes.append(node)
+        return nodes
 
     def get_node_pos(self, string_key):
-        if not self.ring:
+        if not self._points:
             return None
         key = self.gen_key(string_key)
 
-        nodes = self._sorted_keys
+        nodes = self._points
         pos = bisect(nodes, key)
         if pos == len(nodes):
             return 0
         else:
             return pos
 
-    def iterate_nodes(self, string_key, distinct=True):
-        if not self.ring:
-            yield None, None
-
-        returned_values = set()
-
-        def distinct_filter(value):
-            if str(value) not in returned_values:
-                returned_values.add(str(value))
-                return value
+    def get_replicas(self, string_key, n):
+        """first ``n`` distinct nodes clockwise from ``string_key``, the
+        first one being :meth:`get_node`
+        """
+        pos = self.get_node_pos(string_key)
+        if pos is None:
+            return []
+        if n > self.replicas:
+            return list(islice(self.iterate_nodes(string_key), n))
+        node_table = self._node_table
+        return [node_table[idx] for idx in self._get_pref(pos)[:n]]
 
+    def iterate_nodes(self, string_key, distinct=True):
         pos = self.get_node_pos(string_key)
-        for key in self._sorted_keys[pos:]:
-            val = distinct_filter(self.ring[key])
-            if val:
-                yield val
+        if pos is None:
+            return
 
-        for i, key in enumerate(self._sorted_keys):
-            if i < pos:
-                val = distinct_filter(self.ring[key])
-                if val:
-                    yield val
+        returned = set()
+        node_table = self._node_table
+        point_nodes = self._point_nodes
+        size = len(point_nodes)
+        for i in xrange(size):
+            idx = point_nodes[(pos + i) % size]
+            if distinct:
+                if idx in returned:
+                    continue
+                returned.add(idx)
+            yield node_table[idx]
 
     def gen_key(self, key):
-        b_key = self._hash_digest(key)
-        return self._hash_val(b_key, lambda x: x)
-
-    def _hash_val(self, b_key, entry_fn):
-        return (
-            (b_key[entry_fn(3)] << 24)
-            |(b_key[entry_fn(2)] << 16)
-            |(b_key[entry_fn(1)] << 8)
-            |(b_key[entry_fn(0)])
-        )
-
-    def _hash_digest(self, key):
-        m = md5_constructor()
-        m.update(bytes(key))
-        return list(map(ord, str(m.digest())))
-
-
-servers = ['192.168.1.1', '192.168.1.2']
-weights = {
-    '192.168.1.1': 1,
-    '192.168.1.2': 2
-}
-ring = HashRing(servers, weights)
-for i in range(10):
-    key = 'key_%s' % i
-    server = ring.get_node(key)
-    print key, '==>', server
+        return self._hash(key) & 0xffffffff
+
+
+if __name__ == '__main__':
+    servers = ['192.168.1.1', '192.168.1.2']
+    weights = {
+        '192.168.1.1': 1,
+        '192.168.1.2': 2
+    }
+    ring = HashRing(servers, weights)
+    for i in range(10):
+        key = 'key_%s' % i
+        server = ring.get_node(key)
+        print key, '==>', server
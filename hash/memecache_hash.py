@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
-from zlib import crc32
+import os
+import time
+import Queue
+from bisect import bisect_left
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 import memcache
 
+from hashfuncs import get_hash
+
 
 class HashConsistency(object):
-    def __init__(self, nodes=None, replicas=5):
+    def __init__(self, nodes=None, replicas=5, hash_fn='crc32_abs'):
         # 虚拟节点与真实节点对应关系
         self.nodes_map = []
         # 真实节点与虚拟节点的字典映射
@@ -13,6 +20,11 @@ class HashConsistency(object):
         self.nodes = nodes
         # 每个真实节点创建的虚拟节点的个数
         self.replicas = replicas
+        # hashfuncs 中的hash函数
+        self.hash_fn = hash_fn
+        self._hash = get_hash(hash_fn)[0]
+        # nodes_map 中虚拟节点的hash值，用于二分查找
+        self._hashes = []
 
         if self.nodes:
             for node in self.nodes:
@@ -21,15 +33,28 @@ class HashConsistency(object):
 
     def get_node(self, key):
         """ 根据KEY值的hash值，返回对应的节点
-        算法是： 返回最早比key_hash大的节点
+        算法是： 二分查找最早比key_hash大的节点，没有则回到第一个节点
         """
-        key_hash = abs(crc32(key))
-        # print '(%s' % key_hash
-        for node in self.nodes_map:
-            if key_hash > node[0]:
-                continue
-            return node
-        return None
+        if not self.nodes_map:
+            return None
+        pos = bisect_left(self._hashes, self._hash(key))
+        if pos == len(self.nodes_map):
+            pos = 0
+        return self.nodes_map[pos]
+
+    def iterate_nodes(self, key):
+        """ 从key对应的节点开始顺时针遍历，返回不重复的真实节点
+        """
+        if not self.nodes_map:
+            return
+        size = len(self.nodes_map)
+        pos = bisect_left(self._hashes, self._hash(key))
+        returned = set()
+        for i in xrange(size):
+            node = self.nodes_map[(pos + i) % size][1]
+            if node not in returned:
+                returned.add(node)
+                yield node
 
     def add_node(self, node):
         # 添加节点
@@ -38,17 +63,18 @@ class HashConsistency(object):
 
     def remove_node(self, node):
         # 删除节点
-        if node not in self.nodes_replicas.keys():
-            pass
-        discard_rep_nodes = self.nodes_replicas[node]
+        if node not in self.nodes_replicas:
+            return
+        discard_rep_nodes = set(self.nodes_replicas.pop(node))
         self.nodes_map = filter(lambda x: x[0] not in discard_rep_nodes, self.nodes_map)
+        self._hashes = [x[0] for x in self.nodes_map]
 
     def _add_nodes_map(self, node):
         # 增加虚拟节点到nodes_map列表
         nodes_reps = []
         for i in xrange(self.replicas):
             rep_node = '%s_%d' % (node, i)
-            node_hash = abs(crc32(rep_node))
+            node_hash = self._hash(rep_node)
             self.nodes_map.append((node_hash, node))
             nodes_reps.append(node_hash)
         # 真实节点与虚拟节点的字典映射
@@ -57,31 +83,212 @@ class HashConsistency(object):
     def _sort_nodes(self):
         # 按顺序排列虚拟节点
         self.nodes_map = sorted(self.nodes_map, key=lambda x: x[0])
+        self._hashes = [x[0] for x in self.nodes_map]
+
+
+class ShardDownError(Exception):
+    pass
+
+
+class ShardedClient(object):
+    """ 基于 HashConsistency 的分片 memcache 客户端
+
+    批量操作先按分片对 key 分组，每个分片一次 *_multi 请求，各分片并发执行；
+    分片被标记为 dead 后，其 key 顺时针落到环上下一个存活的节点
+    """
+
+    def __init__(self, servers, replicas=5, pool_size=4, dead_retry=30,
+                 socket_timeout=3):
+        self.ring = HashConsistency(servers, replicas)
+        self.pool_size = pool_size
+        self.dead_retry = dead_retry
+        self.socket_timeout = socket_timeout
+        self.servers = list(servers)
+        # 分片 -> 恢复重试的时间
+        self._dead = {}
+        # 每个分片的连接池和并发请求的线程池，按进程惰性创建
+        self._pools = None
+        self._thread_pool = None
+        self._pid = None
+
+    @property
+    def _executor(self):
+        # fork 出的子进程没有父进程线程池的线程，父进程的连接也不能共用
+        if self._pid != os.getpid():
+            self._pools = dict((s, Queue.Queue(self.pool_size))
+                               for s in self.servers)
+            self._thread_pool = ThreadPool(len(self.servers))
+            self._pid = os.getpid()
+        return self._thread_pool
+
+    def mark_dead(self, server):
+        self._dead[server] = time.time() + self.dead_retry
+
+    def is_alive(self, server):
+        dead_until = self._dead.get(server)
+        if dead_until is None:
+            return True
+        if dead_until <= time.time():
+            del self._dead[server]
+            return True
+        return False
+
+    def get_server(self, key):
+        for server in self.ring.iterate_nodes(key):
+            if self.is_alive(server):
+                return server
+        return None
+
+    @contextmanager
+    def _client(self, server):
+        pool = self._pools[server]
+        try:
+            mc = pool.get_nowait()
+        except Queue.Empty:
+            mc = memcache.Client([server], dead_retry=self.dead_retry,
+                                 socket_timeout=self.socket_timeout)
+        try:
+            yield mc
+        finally:
+            try:
+                pool.put_nowait(mc)
+            except Queue.Full:
+                mc.disconnect_all()
+
+    def _call(self, server, method, *args, **kwargs):
+        with self._client(server) as mc:
+            host = mc.servers[0]
+            if not host.connect():
+                raise ShardDownError(server)
+            result = getattr(mc, method)(*args, **kwargs)
+            # 请求过程中连接出错，memcache.Client 会把 host 标记为 dead
+            if host.deaduntil:
+                raise ShardDownError(server)
+            return result
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            server = self.get_server(key)
+            if server is None:
+                raise ShardDownError('no alive server for %r' % key)
+            groups.setdefault(server, []).append(key)
+        return groups
+
+    def _fanout(self, keys, method, make_args, **kwargs):
+        """ 按分片并发执行 ``method``，失败的分片标记为 dead 后重新分组重试，
+        返回 {server: result}
+        """
+        results = {}
+        while keys:
+            groups = self._group(keys)
+            calls = [
+                (server, self._executor.apply_async(
+                    self._call, (server, method, make_args(group)), kwargs))
+                for server, group in groups.iteritems()]
+            keys = []
+            for server, call in calls:
+                try:
+                    results[server] = call.get()
+                except ShardDownError:
+                    self.mark_dead(server)
+                    keys.extend(groups[server])
+        return results
+
+    def get_multi(self, keys):
+        values = {}
+        for result in self._fanout(keys, 'get_multi', list).itervalues():
+            values.update(result)
+        return values
+
+    def set_multi(self, mapping, time=0):
+        """ 返回没有设置成功的 key 列表
+        """
+        notset = []
+        results = self._fanout(
+            mapping.keys(), 'set_multi',
+            lambda group: dict((k, mapping[k]) for k in group), time=time)
+        for result in results.itervalues():
+            notset.extend(result)
+        return notset
+
+    def delete_multi(self, keys):
+        results = self._fanout(keys, 'delete_multi', list)
+        return all(results.itervalues())
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        self._thread_pool.close()
+        for pool in self._pools.itervalues():
+            while not pool.empty():
+                pool.get_nowait().disconnect_all()
+
+
+if __name__ == '__main__':
+    import threading
+    import SocketServer
+
+    class StandInMemcachedHandler(SocketServer.StreamRequestHandler):
+        """ 只支持 get/gets/set/delete 的 memcached 文本协议
+        """
+
+        def handle(self):
+            store = self.server.store
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                parts = line.split()
+                cmd, args = parts[0], parts[1:]
+                if cmd in ('get', 'gets'):
+                    for key in args:
+                        if key in store:
+                            flags, data = store[key]
+                            self.wfile.write('VALUE %s %s %d\r\n%s\r\n'
+                                             % (key, flags, len(data), data))
+                    self.wfile.write('END\r\n')
+                elif cmd == 'set':
+                    key, flags, _, length = args[:4]
+                    data = self.rfile.read(int(length) + 2)[:-2]
+                    store[key] = (flags, data)
+                    if 'noreply' not in args:
+                        self.wfile.write('STORED\r\n')
+                elif cmd == 'delete':
+                    found = store.pop(args[0], None) is not None
+                    if 'noreply' not in args:
+                        self.wfile.write(
+                            'DELETED\r\n' if found else 'NOT_FOUND\r\n')
+                else:
+                    self.wfile.write('ERROR\r\n')
+
+    class StandInMemcached(SocketServer.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def __init__(self):
+            SocketServer.ThreadingTCPServer.__init__(
+                self, ('127.0.0.1', 0), StandInMemcachedHandler)
+            self.store = {}
+            t = threading.Thread(target=self.serve_forever)
+            t.daemon = True
+            t.start()
+
+    stand_ins = [StandInMemcached() for _ in range(4)]
+    memcache_servers = ['127.0.0.1:%d' % s.server_address[1]
+                        for s in stand_ins]
 
+    client = ShardedClient(memcache_servers)
+    keys = ['key_%s' % i for i in xrange(100)]
+    assert client.set_multi(dict((k, i) for i, k in enumerate(keys))) == []
+    assert client.get_multi(keys) == dict((k, i) for i, k in enumerate(keys))
+    for server, stand_in in zip(memcache_servers, stand_ins):
+        print 'SERVER :%s keys: %d' % (server, len(stand_in.store))
 
-memcache_servers = [
-    '127.0.0.1:7001',
-    '127.0.0.1:7002',
-    '127.0.0.1:7003',
-    '127.0.0.1:7004',
-]
-
-h = HashConsistency(memcache_servers)
-
-for k in h.nodes_map:
-    print k
-
-mc_servers_dict = {}
-for ms in memcache_servers:
-    mc = memcache.Client([ms], debug=0)
-    mc_servers_dict[ms] = mc
-
-# 循环10次给memcache 添加key，这里使用了一致性hash，那么key将会根据hash值落点到对应的虚拟节点上
-for i in xrange(10):
-    key = 'key_%s' % i
-    print key
-    server = h.get_node(key)[1]
-    mc = mc_servers_dict[server]
-    mc.set(key, i)
-    print 'SERVER :%s' % server
-    print mc
+    # 标记一个分片为 dead，它的 key 落到环上的下一个节点
+    client.mark_dead(memcache_servers[0])
+    assert client.set_multi(dict((k, k) for k in keys)) == []
+    assert client.get_multi(keys) == dict((k, k) for k in keys)
+    assert client.delete_multi(keys)
+    assert client.get_multi(keys) == {}
+    client.close()
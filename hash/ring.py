@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""One ring interface with pluggable engines
+
+    ring = create_ring('maglev', ['10.0.0.1', '10.0.0.2'])
+    ring.get_node('key')
+    ring.get_nodes(['key1', 'key2'])
+    ring.add_node('10.0.0.3')
+    ring.remove_node('10.0.0.1')
+
+engines:
+
+* ``ketama``: :class:`hashring.HashRing`, weighted, ~120 vnodes per node
+* ``yhash``: :class:`consistent_hash.YHash`, md5 vnodes
+* ``jump``: jump consistent hash, no memory, best balance, only appending
+  or removing the last node moves the minimum of keys
+* ``rendezvous``: weighted highest random weight, O(nodes) per lookup
+* ``maglev``: Maglev lookup table, O(1) lookup, rebuilt on change
+"""
+
+import abc
+import math
+import struct
+import hashlib
+from array import array
+
+from hashring import HashRing
+from consistent_hash import YHash
+
+_MASK64 = 0xffffffffffffffff
+
+
+def hash64(key):
+    """64 bits of the md5 digest of ``key``"""
+    return struct.unpack_from('<Q', hashlib.md5(key).digest())[0]
+
+
+def _mix64(x):
+    # splitmix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+
+def jump_hash(key, num_buckets):
+    """Lamping & Veach, "A Fast, Minimal Memory, Consistent Hash Algorithm"
+    """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941819 + 1) & _MASK64
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class Ring(object):
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def get_node(self, key):
+        """node for ``key``, ``None`` if the ring is empty"""
+        return
+
+    def get_nodes(self, keys):
+        return [self.get_node(k) for k in keys]
+
+    @abc.abstractmethod
+    def add_node(self, node):
+        return
+
+    @abc.abstractmethod
+    def remove_node(self, node):
+        return
+
+
+Ring.register(HashRing)
+Ring.register(YHash)
+
+
+class JumpRing(Ring):
+    def __init__(self, nodes=None):
+        self.nodes = list(nodes or [])
+
+    def get_node(self, key):
+        if not self.nodes:
+            return None
+        return self.nodes[jump_hash(hash64(key), len(self.nodes))]
+
+    def get_nodes(self, keys):
+        nodes = self.nodes
+        if not nodes:
+            return [None] * len(keys)
+        n = len(nodes)
+        return [nodes[jump_hash(hash64(k), n)] for k in keys]
+
+    def add_node(self, node):
+        if node in self.nodes:
+            raise ValueError('node %r already in ring' % (node,))
+        self.nodes.append(node)
+
+    def remove_node(self, node):
+        """the last node takes the bucket of the removed one, so apart
+        from keys of ``node`` only keys of the last bucket move
+        """
+        try:
+            pos = self.nodes.index(node)
+        except ValueError:
+            raise ValueError('node %r not in ring' % (node,))
+        last = self.nodes.pop()
+        if pos < len(self.nodes):
+            self.nodes[pos] = last
+
+
+class RendezvousRing(Ring):
+    def __init__(self, nodes=None, weights=None):
+        self.nodes = []
+        self.weights = {}
+        # (node, seed, weight)
+        self._entries = []
+        weights = weights or {}
+        for node in nodes or []:
+            self.add_node(node, weights.get(node, 1))
+
+    def _score(self, seed, key_hash, weight):
+        # uniform in (0, 1), weighted as -w / ln(u)
+        u = (_mix64(seed ^ key_hash) + 0.5) / float(1 << 64)
+        return -weight / math.log(u)
+
+    def get_node(self, key):
+        if not self._entries:
+            return None
+        key_hash = hash64(key)
+        score = self._score
+        best, best_score = None, -1.0
+        for node, seed, weight in self._entries:
+            s = score(seed, key_hash, weight)
+            if s > best_score:
+                best, best_score = node, s
+        return best
+
+    def add_node(self, node, weight=1):
+        if node in self.weights:
+            raise ValueError('node %r already in ring' % (node,))
+        self.nodes.append(node)
+        self.weights[node] = weight
+        self._entries.append((node, hash64(str(node)), weight))
+
+    def remove_node(self, node):
+        if node not in self.weights:
+            raise ValueError('node %r not in ring' % (node,))
+        self.nodes.remove(node)
+        del self.weights[node]
+        self._entries = [e for e in self._entries if e[0] != node]
+
+    def set_weight(self, node, weight):
+        self.remove_node(node)
+        self.add_node(node, weight)
+
+
+class MaglevRing(Ring):
+    """``table_size`` should be a prime much larger than the node count,
+    e.g. 100 times
+    """
+
+    def __init__(self, nodes=None, table_size=65537):
+        self.nodes = list(nodes or [])
+        self.table_size = table_size
+        self._table = array('I')
+        self._populate()
+
+    def _populate(self):
+        m = self.table_size
+        n = len(self.nodes)
+        if not n:
+            self._table = array('I')
+            return
+        offsets, skips = [], []
+        for node in self.nodes:
+            h = hash64(str(node))
+            offsets.append((h & 0xffffffff) % m)
+            skips.append((h >> 32) % (m - 1) + 1)
+
+        next_ = [0] * n
+        entry = [-1] * m
+        filled = 0
+        while True:
+            for i in xrange(n):
+                offset, skip = offsets[i], skips[i]
+                c = (offset + next_[i] * skip) % m
+                while entry[c] >= 0:
+                    next_[i] += 1
+                    c = (offset + next_[i] * skip) % m
+                entry[c] = i
+                next_[i] += 1
+                filled += 1
+                if filled == m:
+                    self._table = array('I', entry)
+                    return
+
+    def get_node(self, key):
+        if not self.nodes:
+            return None
+        return self.nodes[self._table[hash64(key) % self.table_size]]
+
+    def get_nodes(self, keys):
+        nodes = self.nodes
+        if not nodes:
+            return [None] * len(keys)
+        table = self._table
+        m = self.table_size
+        return [nodes[table[hash64(k) % m]] for k in keys]
+
+    def add_node(self, node):
+        if node in self.nodes:
+            raise ValueError('node %r already in ring' % (node,))
+        self.nodes.append(node)
+        self._populate()
+
+    def remove_node(self, node):
+        try:
+            self.nodes.remove(node)
+        except ValueError:
+            raise ValueError('node %r not in ring' % (node,))
+        self._populate()
+
+
+RING_ENGINES = {
+    'ketama': HashRing,
+    'yhash': YHash,
+    'jump': JumpRing,
+    'rendezvous': RendezvousRing,
+    'maglev': MaglevRing,
+}
+
+
+def create_ring(engine, nodes=None, **kwargs):
+    try:
+        ring_cls = RING_ENGINES[engine]
+    except KeyError:
+        raise ValueError('unknown ring engine: {!r}'.format(engine))
+    return ring_cls(nodes, **kwargs)
+
+
+if __name__ == '__main__':
+    servers = ['192.168.1.%d' % i for i in range(1, 5)]
+    keys = ['key_%s' % i for i in range(10000)]
+    for engine in sorted(RING_ENGINES):
+        ring = create_ring(engine, servers)
+        before = ring.get_nodes(keys)
+        ring.add_node('192.168.1.5')
+        after = ring.get_nodes(keys)
+        moved = sum(1 for a, b in zip(before, after) if a != b)
+        print '%-10s moved %.2f%% keys on adding a node' % (
+            engine, 100.0 * moved / len(keys))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""Hash ranges that change owner between two versions of a ring
+
+    old_ring = copy.deepcopy(ring)
+    ring.add_node('192.168.1.3')
+    for start, end, old_node, new_node in diff(old_ring, ring):
+        ...
+    for key, old_node, new_node in keys_to_move(old_ring, ring, keys):
+        ...
+
+Ranges are inclusive ``[start, end]`` intervals of key hashes, arcs
+wrapping around the top of the hash space are split in two.  Only the
+vnodes present in one ring but not the other are walked, so the cost is
+O(changed vnodes * log(vnodes)) on top of a set difference of the points.
+"""
+
+from bisect import bisect, bisect_left, bisect_right
+
+from hashfuncs import get_hash
+from hashring import HashRing
+from consistent_hash import YHash
+from memecache_hash import HashConsistency
+
+
+class _RingView(object):
+    """sorted points of a ring and how keys land on them
+
+    ``right`` rings send a key to the first point greater than its hash,
+    the others to the first point greater than or equal to it
+    """
+
+    def __init__(self, points, owner, hash_key, max_hash, right):
+        self.points = points
+        self.owner = owner
+        self.hash_key = hash_key
+        self.max_hash = max_hash
+        self.right = right
+
+    def node_for_hash(self, h):
+        points = self.points
+        if not points:
+            return None
+        pos = (bisect if self.right else bisect_left)(points, h)
+        if pos == len(points):
+            pos = 0
+        return self.owner(pos)
+
+
+def _ring_view(ring):
+    if isinstance(ring, HashRing):
+        return _RingView(
+            ring._points,
+            lambda pos: ring._node_table[ring._point_nodes[pos]],
+            ring.gen_key, 0xffffffff, True)
+    if isinstance(ring, YHash):
+        return _RingView(
+            ring._sort_list,
+            lambda pos: ring._node_dict[ring._sort_list[pos]],
+            ring._gen_key, get_hash(ring.hash_fn)[1], False)
+    if isinstance(ring, HashConsistency):
+        return _RingView(
+            ring._hashes,
+            lambda pos: ring.nodes_map[pos][1],
+            ring._hash, get_hash(ring.hash_fn)[1], False)
+    raise TypeError('unsupported ring: %r' % (ring,))
+
+
+def _prev_point(points, p):
+    pos = bisect_left(points, p)
+    if pos:
+        return points[pos - 1]
+    return points[-1] if points else None
+
+
+def diff(old_ring, new_ring):
+    """yield ``(range_start, range_end, old_node, new_node)`` for every
+    hash range whose owner differs, in hash order
+    """
+    if (type(old_ring) is not type(new_ring) or
+            old_ring.hash_fn != new_ring.hash_fn):
+        raise TypeError('can not diff %r with %r' % (old_ring, new_ring))
+    old = _ring_view(old_ring)
+    new = _ring_view(new_ring)
+    changed = sorted(set(old.points).symmetric_difference(new.points))
+
+    for p in changed:
+        # the arc of the union ring ending at ``p`` has one owner in
+        # each ring, since no other point of either ring lies inside it
+        prevs = [x for x in (_prev_point(old.points, p),
+                             _prev_point(new.points, p))
+                 if x is not None and x != p]
+        below = [x for x in prevs if x < p]
+        prev = max(below) if below else (max(prevs) if prevs else p)
+
+        if new.right:
+            # keys in [prev, p) land on p
+            start, end = prev, p - 1
+        else:
+            # keys in (prev, p] land on p
+            start, end = prev + 1, p
+        key_hash = end if end >= 0 else new.max_hash
+        old_node = old.node_for_hash(key_hash)
+        new_node = new.node_for_hash(key_hash)
+        if old_node == new_node:
+            continue
+        if prev >= p:
+            # wraps around the top of the hash space
+            if start <= new.max_hash:
+                yield start, new.max_hash, old_node, new_node
+            if end >= 0:
+                yield 0, end, old_node, new_node
+        else:
+            yield start, end, old_node, new_node
+
+
+def keys_to_move(old_ring, new_ring, keys):
+    """yield ``(key, old_node, new_node)`` for the keys of ``keys`` whose
+    node changed, only keys falling into a changed range are looked up
+    """
+    ranges = sorted(diff(old_ring, new_ring))
+    if not ranges:
+        return
+    starts = [r[0] for r in ranges]
+    hash_key = _ring_view(new_ring).hash_key
+    for key in keys:
+        h = hash_key(key)
+        i = bisect_right(starts, h) - 1
+        if i >= 0 and h <= ranges[i][1]:
+            yield key, ranges[i][2], ranges[i][3]
+
+
+if __name__ == '__main__':
+    import copy
+
+    ring = HashRing(['192.168.1.1', '192.168.1.2'])
+    old_ring = copy.deepcopy(ring)
+    ring.add_node('192.168.1.3')
+
+    ranges = list(diff(old_ring, ring))
+    print '%d ranges changed owner' % len(ranges)
+    keys = ['key_%s' % i for i in xrange(10000)]
+    moved = list(keys_to_move(old_ring, ring, keys))
+    assert moved == [(k, old_ring.get_node(k), ring.get_node(k))
+                     for k in keys if old_ring.get_node(k) != ring.get_node(k)]
+    print '%d of %d keys to move' % (len(moved), len(keys))
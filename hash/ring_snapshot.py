@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""Share one built :class:`hashring.HashRing` between prefork workers
+
+The master builds the ring once and dumps it::
+
+    dump_ring(ring, '/dev/shm/ring')
+
+every worker maps the file and looks keys up straight from the mapped
+pages, which are shared by all of them::
+
+    ring = MappedRing('/dev/shm/ring')
+    ring.get_node('key')
+
+Dumping again writes a new file with a bigger epoch and renames it over
+the old one, workers swap their mapping on the next check.
+
+File layout, little endian::
+
+    header   magic 'HRNG', version u16, reserved u16, epoch u64,
+             point count u32, node count u32, hash function name 16s
+    points   u32 * point count, sorted
+    owners   u32 * point count, index into the node table
+    nodes    (u16 length, utf-8 bytes) * node count
+"""
+
+import os
+import mmap
+import time
+import struct
+from array import array
+
+from hashfuncs import get_hash
+from hashring import HashRing
+
+MAGIC = 'HRNG'
+VERSION = 2
+
+_HEADER = struct.Struct('<4sHHQII16s')
+_U32 = struct.Struct('<I')
+_U16 = struct.Struct('<H')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _read_header(buf):
+    magic, version = _HEADER.unpack_from(buf)[:2]
+    if magic != MAGIC:
+        raise SnapshotError('not a ring snapshot')
+    if version != VERSION:
+        raise SnapshotError('unsupported snapshot version: %d' % version)
+    _, _, _, epoch, n_points, n_nodes, hash_fn = _HEADER.unpack_from(buf)
+    return epoch, n_points, n_nodes, hash_fn.rstrip('\0')
+
+
+def read_epoch(path):
+    with open(path, 'rb') as f:
+        return _read_header(f.read(_HEADER.size))[0]
+
+
+def dump_ring(ring, path, epoch=None):
+    """write ``ring`` to ``path`` atomically, ``epoch`` defaults to the
+    epoch of the current file plus one
+    """
+    if epoch is None:
+        try:
+            epoch = read_epoch(path) + 1
+        except (IOError, OSError, SnapshotError, struct.error):
+            epoch = 1
+
+    # compact the node table, removed nodes leave holes in it
+    table_idx = {}
+    nodes = []
+    for idx, node in enumerate(ring._node_table):
+        if node is not None:
+            table_idx[idx] = len(nodes)
+            nodes.append(node)
+    owners = array('I', [table_idx[idx] for idx in ring._point_nodes])
+    points = ring._points
+    if struct.pack('=H', 1) != _U16.pack(1):
+        points = array('I', points)
+        points.byteswap()
+        owners.byteswap()
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, epoch,
+                             len(points), len(nodes), ring.hash_fn))
+        points.tofile(f)
+        owners.tofile(f)
+        for node in nodes:
+            name = unicode(node).encode('utf-8')
+            f.write(_U16.pack(len(name)))
+            f.write(name)
+    os.rename(tmp_path, path)
+    return epoch
+
+
+class MappedRing(object):
+    """read only ring served from a snapshot file, ``check_interval`` is
+    how often in seconds lookups check the file for a new epoch
+    """
+
+    def __init__(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self._state = None
+        self._next_check = 0
+        self.reload()
+
+    @property
+    def epoch(self):
+        return self._state[1]
+
+    @property
+    def nodes(self):
+        return list(self._state[3])
+
+    def reload(self):
+        """map the file again if its epoch changed, return whether it did
+        """
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        epoch, n_points, n_nodes, hash_fn = _read_header(mm)
+        if self._state is not None and self._state[1] == epoch:
+            mm.close()
+            return False
+
+        nodes = []
+        offset = _HEADER.size + n_points * 8
+        for _ in xrange(n_nodes):
+            length, = _U16.unpack_from(mm, offset)
+            offset += 2
+            nodes.append(mm[offset:offset + length].decode('utf-8'))
+            offset += length
+
+        # lookups in flight keep using the old mapping until they drop it
+        self._state = (mm, epoch, n_points, nodes, get_hash(hash_fn)[0])
+        return True
+
+    def _maybe_reload(self):
+        now = time.time()
+        if now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            if read_epoch(self.path) != self._state[1]:
+                self.reload()
+        except (IOError, OSError, SnapshotError):
+            pass
+
+    def _lookup(self, state, key):
+        mm, _, n_points, nodes, hash_ = state
+        if not n_points:
+            return None
+        key = hash_(key) & 0xffffffff
+        unpack_from = _U32.unpack_from
+        base = _HEADER.size
+        # bisect right over the mapped points
+        lo, hi = 0, n_points
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key < unpack_from(mm, base + mid * 4)[0]:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == n_points:
+            lo = 0
+        return nodes[unpack_from(mm, base + (n_points + lo) * 4)[0]]
+
+    def get_node(self, string_key):
+        self._maybe_reload()
+        return self._lookup(self._state, string_key)
+
+    def get_nodes(self, keys):
+        self._maybe_reload()
+        state = self._state
+        return [self._lookup(state, k) for k in keys]
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'ring')
+    servers = ['192.168.1.%d' % i for i in range(1, 65)]
+    ring = HashRing(servers)
+    dump_ring(ring, path)
+
+    mapped = MappedRing(path, check_interval=0)
+    keys = ['key_%s' % i for i in xrange(10000)]
+    assert mapped.get_nodes(keys) == ring.get_nodes(keys)
+
+    ring.remove_node('192.168.1.1')
+    print 'epoch', dump_ring(ring, path)
+    assert mapped.get_nodes(keys) == ring.get_nodes(keys)
+    print 'mapped ring matches, epoch', mapped.epoch
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Bounded LRU cache of key -> node in front of ring lookups
+
+The whole cache is dropped as soon as it is read with another topology
+epoch than the one it was filled with, rings bump their epoch on every
+add / remove.
+"""
+
+MISSING = object()
+
+# fields of a link in the circular doubly linked list
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class RouteCache(object):
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.epoch = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._map = {}
+        # root of the list, root[NEXT] is the least recently used link
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def clear(self):
+        self._map.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def get(self, key, epoch):
+        if epoch != self.epoch:
+            if self._map:
+                self.invalidations += 1
+                self.clear()
+            self.epoch = epoch
+        link = self._map.get(key)
+        if link is None:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        # move to the most recently used end
+        prev, next_ = link[PREV], link[NEXT]
+        prev[NEXT] = next_
+        next_[PREV] = prev
+        root = self._root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = link
+        link[PREV], link[NEXT] = last, root
+        return link[VALUE]
+
+    def put(self, key, value):
+        """cache ``value``, always after a :meth:`get` of the same key and
+        epoch missed
+        """
+        root = self._root
+        if len(self._map) >= self.maxsize:
+            oldest = root[NEXT]
+            root[NEXT] = oldest[NEXT]
+            oldest[NEXT][PREV] = root
+            del self._map[oldest[KEY]]
+        last = root[PREV]
+        link = [last, root, key, value]
+        last[NEXT] = root[PREV] = self._map[key] = link
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._map),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+        }
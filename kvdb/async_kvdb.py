@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Cooperative flavour of :class:`kvdb.BaseKeyValueDB` on gevent
+
+python 2 has no asyncio, the db talks to redis from greenlets instead:
+generated methods spawn one and return it right away, ``.get()`` waits
+for the value without blocking the other greenlets::
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    class MyKeyValueDB(KeyBindingMixin, AsyncBaseKeyValueDB):
+        __namespace__ = 'my:space'
+        KEYS = dict(
+            app_service_info=('app:{app}:service_info', 'json'),
+        )
+
+    db = MyKeyValueDB('redis://127.0.0.1:6379')
+    infos = [db.app_service_info(app=app) for app in apps]
+    gevent.joinall(infos)
+    [info.value for info in infos]
+
+``KEYS``, key binding, read cache and pipelines behave as in
+:class:`kvdb.BaseKeyValueDB`, pipelines execute in the calling greenlet.
+"""
+
+import gevent
+from gevent import monkey
+from redis import Redis, BlockingConnectionPool
+
+from kvdb import BaseKeyValueDB
+
+
+class AsyncBaseKeyValueDB(BaseKeyValueDB):
+    """
+    at most ``max_connections`` commands are in flight, the other
+    greenlets wait for a free connection of the pool, up to
+    ``pool_timeout`` seconds
+    """
+    KEYS = {}
+
+    def __init__(self, url, max_connections=50, pool_timeout=20):
+        if not monkey.is_module_patched('socket'):
+            raise RuntimeError('gevent.monkey.patch_all() needs to be called'
+                               ' before using %s' % type(self).__name__)
+        self.client = Redis(connection_pool=BlockingConnectionPool.from_url(
+            url, max_connections=max_connections, timeout=pool_timeout))
+
+    def _execute(self, commands, parse=None, transaction=True, cached=False,
+                 writes=()):
+        return gevent.spawn(BaseKeyValueDB._execute.__func__, self, commands,
+                            parse, transaction, cached, writes)
+
+    def _wait(self, result):
+        return result.get()
+
+    def _when_done(self, result, callback):
+        if isinstance(result, gevent.Greenlet):
+            result.link(lambda g: callback(not g.successful()))
+        else:
+            callback(False)
+
+    def _update_json(self, key, codec, parse, op, *args):
+        return gevent.spawn(BaseKeyValueDB._update_json.__func__, self, key,
+                            codec, parse, op, *args)
+
+
+if __name__ == '__main__':
+    monkey.patch_all()
+
+    import time
+    from kvdb import KeyBindingMixin, DictValidator
+
+    class MyAsyncKeyValueDB(KeyBindingMixin, AsyncBaseKeyValueDB):
+        __namespace__ = 'my:async:space'
+
+        KEYS = dict(
+            app_service_info=(
+                'app:{app}:service_info', 'json', ('app', 'port'),
+                DictValidator({'app': {'type': 'string'},
+                               'port': {'type': 'integer'}})
+            )
+        )
+
+    db = MyAsyncKeyValueDB('redis://localhost:6379')
+    apps = ['app%d' % i for i in xrange(2000)]
+    with db.pipeline() as p:
+        for i, app in enumerate(apps):
+            p.set_app_service_info({'app': app, 'port': 8000 + i}, app=app)
+
+    start = time.time()
+    infos = [db.app_service_info('port', app=app) for app in apps]
+    gevent.joinall(infos, raise_error=True)
+    print '%d concurrent reads in %.3fs' % (len(infos), time.time() - start)
+    print infos[0].value  # {'port': 8000}
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Stored bytes and encode / decode time of every codec on sample service
+info documents
+
+    python bench_codec.py [documents] [instances per document]
+"""
+
+import sys
+import time
+
+from codec import Codec, msgpack, lz4_frame
+
+CODECS = [
+    ('json', Codec()),
+    ('compact_json', Codec('compact_json')),
+    ('compact_json+zlib', Codec('compact_json', 'zlib', threshold=0)),
+]
+if lz4_frame is not None:
+    CODECS.append(
+        ('compact_json+lz4', Codec('compact_json', 'lz4', threshold=0)))
+if msgpack is not None:
+    CODECS.append(('msgpack', Codec('msgpack')))
+    CODECS.append(('msgpack+zlib', Codec('msgpack', 'zlib', threshold=0)))
+    if lz4_frame is not None:
+        CODECS.append(('msgpack+lz4', Codec('msgpack', 'lz4', threshold=0)))
+
+
+def service_info(i, n_instances):
+    return {
+        'app': 'app_%d' % i,
+        'cluster': 'prod',
+        'owner': 'team-%d@example.com' % (i % 7),
+        'port': 8000 + i,
+        'thrift_protocol': 'binary',
+        'timeout_ms': 3000,
+        'instances': [
+            {'host': '10.0.%d.%d' % (j // 256, j % 256),
+             'port': 8000 + i,
+             'weight': 100,
+             'zone': 'zone-%d' % (j % 3),
+             'healthy': True}
+            for j in xrange(n_instances)
+        ],
+    }
+
+
+def bench(codec, docs):
+    start = time.time()
+    encoded = [codec.encode(d) for d in docs]
+    encode_time = time.time() - start
+    start = time.time()
+    for e in encoded:
+        codec.decode(e)
+    decode_time = time.time() - start
+    return {
+        'bytes': sum(len(e) for e in encoded),
+        'encode_us': encode_time / len(docs) * 1e6,
+        'decode_us': decode_time / len(docs) * 1e6,
+    }
+
+
+def main(n_docs=1000, n_instances=20):
+    docs = [service_info(i, n_instances) for i in xrange(n_docs)]
+    print '%-20s %12s %8s %10s %10s' % (
+        'codec', 'bytes', 'ratio', 'encode us', 'decode us')
+    baseline = None
+    for name, codec in CODECS:
+        r = bench(codec, docs)
+        baseline = baseline or r['bytes']
+        print '%-20s %12d %8.3f %10.1f %10.1f' % (
+            name, r['bytes'], float(r['bytes']) / baseline,
+            r['encode_us'], r['decode_us'])
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Per call overhead of the generated methods without redis: key
+building, binding merge and validation, the way they were done before
+key templates were compiled and validators cached, and now
+
+    python bench_kvdb.py [calls]
+"""
+
+import sys
+import time
+
+import cerberus
+
+from kvdb import KeyBindingMixin, BaseKeyValueDB, DictValidator
+
+SCHEMA = {
+    'app': {'type': 'string'},
+    'port': {'type': 'integer'},
+}
+
+
+class LegacyDictValidator(DictValidator):
+
+    def validate(self, value, update=False):
+        v = cerberus.Validator(schema=self.schema, allow_unknown=True)
+        return v.validate(value, update=update)
+
+
+class BenchKeyValueDB(KeyBindingMixin, BaseKeyValueDB):
+    __namespace__ = 'bench:space'
+
+    KEYS = dict(
+        app_service_info=('app:{app}:cluster:{cluster}:service_info',
+                          'json', ('app', 'port'), DictValidator(SCHEMA)),
+    )
+
+    def __init__(self):
+        # no client, commands are returned instead of run
+        self.bind_key(app='app1')
+
+    def _execute(self, commands, parse=None, transaction=True, cached=False,
+                 writes=()):
+        return commands
+
+
+class LegacyKeyValueDB(BenchKeyValueDB):
+    """key building and validation as they were before"""
+
+    KEYS = dict(
+        app_service_info=('app:{app}:cluster:{cluster}:service_info',
+                          'json', ('app', 'port'),
+                          LegacyDictValidator(SCHEMA)),
+    )
+
+    def make_key(self, id_, kwargs):
+        binding = self.binding
+        binding.update(kwargs)
+        full_key_pat = self.namespace + ':' + self.KEYS[id_][0]
+        return full_key_pat.format(**binding)
+
+
+def timeit(f, n):
+    start = time.time()
+    for _ in xrange(n):
+        f()
+    return (time.time() - start) / n * 1e6
+
+
+def main(n=100000):
+    value = {'app': 'app1', 'port': 8000}
+    kwargs = {'cluster': 'c1'}
+    before, after = LegacyKeyValueDB(), BenchKeyValueDB()
+
+    def cases(db):
+        validator = db.KEYS['app_service_info'][3]
+        return [
+            ('make_key', lambda: db.make_key('app_service_info', kwargs), n),
+            ('validate', lambda: validator.validate(value), n // 10),
+            ('getter', lambda: db.app_service_info(cluster='c1'), n),
+            ('setter', lambda: db.set_app_service_info(value, cluster='c1'),
+             n // 10),
+        ]
+
+    print '%-10s %12s %12s %8s' % ('call', 'before us', 'after us', 'speedup')
+    for (name, b, calls), (_, a, _) in zip(cases(before), cases(after)):
+        b, a = timeit(b, calls), timeit(a, calls)
+        print '%-10s %12.2f %12.2f %8.2f' % (name, b, a, b / a)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
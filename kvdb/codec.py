@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Value codecs of ``json`` keys
+
+Encoded values carry a 3 bytes header, ``\\xff``, the serializer
+(``j`` json, ``m`` msgpack) and the compression (``n`` none, ``z`` zlib,
+``4`` lz4).  Plain json is stored as is, without header, so values
+written before codecs existed, or by another codec, are always readable
+by :func:`decode_value`.
+"""
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+HEADER = '\xff'
+
+SERIALIZERS = ('json', 'compact_json', 'msgpack')
+COMPRESSIONS = (None, 'zlib', 'lz4')
+
+
+def decode_value(data):
+    if data[:1] != HEADER:
+        return json.loads(data)
+    serializer, compression, body = data[1], data[2], data[3:]
+    if compression == 'z':
+        body = zlib.decompress(body)
+    elif compression == '4':
+        body = lz4_frame.decompress(body)
+    if serializer == 'm':
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+class Codec(object):
+    """
+    ``serializer`` is one of ``json``, ``compact_json`` (no whitespace) and
+    ``msgpack``, values of at least ``threshold`` serialized bytes are
+    compressed with ``compression``, ``zlib`` or ``lz4``::
+
+        KEYS = dict(
+            app_service_info=('app:{app}:service_info', 'json', (), None,
+                              Codec('compact_json', 'zlib')),
+        )
+    """
+
+    def __init__(self, serializer='json', compression=None, threshold=1024,
+                 level=6):
+        if serializer not in SERIALIZERS:
+            raise ValueError('unknown serializer: {!r}'.format(serializer))
+        if compression not in COMPRESSIONS:
+            raise ValueError('unknown compression: {!r}'.format(compression))
+        if serializer == 'msgpack' and msgpack is None:
+            raise ValueError('msgpack is not installed')
+        if compression == 'lz4' and lz4_frame is None:
+            raise ValueError('lz4 is not installed')
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+
+    def __repr__(self):
+        return '<Codec %s %s>' % (self.serializer, self.compression)
+
+    def encode(self, value):
+        if self.serializer == 'msgpack':
+            body, serializer = msgpack.packb(value, use_bin_type=True), 'm'
+        elif self.serializer == 'compact_json':
+            body, serializer = json.dumps(value, separators=(',', ':')), 'j'
+        else:
+            body, serializer = json.dumps(value), 'j'
+
+        if self.compression is not None and len(body) >= self.threshold:
+            if self.compression == 'zlib':
+                return HEADER + serializer + 'z' + zlib.compress(
+                    body, self.level)
+            return HEADER + serializer + '4' + lz4_frame.compress(body)
+        if serializer == 'm':
+            return HEADER + 'mn' + body
+        return body
+
+    decode = staticmethod(decode_value)
+
+
+JSON = Codec()
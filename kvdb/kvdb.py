@@ -1,11 +1,161 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import re
 import json
 import abc
-import cerberus
+import time
+import threading
+from string import Formatter
+from itertools import islice
+from collections import OrderedDict
 
+import cerberus
 from redis import Redis
+from redis.exceptions import ConnectionError, WatchError
+
+from codec import JSON, decode_value
+from sharding import ShardedRedis
+from metrics import KeyMetrics, payload_size
+
+MISSING = object()
+
+_FIELD_NAME = re.compile(r'^[A-Za-z_]\w*$')
+_GLOB_SPECIAL = re.compile(r'([\\*?\[\]])')
+
+
+def _decode_json(value_json, attrs=()):
+    if not value_json:
+        return
+    value_dict = decode_value(value_json)
+    if attrs:
+        value_attrs = {}
+        for a in attrs:
+            if a in value_dict:
+                value_attrs[a] = value_dict[a]
+        return value_attrs
+    return value_dict
+
+
+def _apply_json_update(doc, op, *args):
+    """partial update of the decoded json value ``doc``, ``op`` and
+    ``args`` being ``set <field> <json value>``, ``unset <field>``,
+    ``incr <field> <amount>`` or ``merge <json object>``; returns the json
+    of the new value for ``incr``, else 1
+    """
+    if op == 'set':
+        doc[args[0]] = json.loads(args[1])
+    elif op == 'unset':
+        doc.pop(args[0], None)
+    elif op == 'incr':
+        value = doc.get(args[0], 0)
+        if not isinstance(value, (int, long, float)):
+            raise ValueError('field %s is not a number' % args[0])
+        doc[args[0]] = value + args[1]
+        return json.dumps(doc[args[0]])
+    elif op == 'merge':
+        doc.update(json.loads(args[0]))
+    else:
+        raise ValueError('unknown op %s' % op)
+    return 1
+
+
+class KeyTemplate(object):
+    """a key pattern compiled once, ``format(mapping)`` builds the key,
+    ``glob(mapping)`` the SCAN MATCH pattern of its keys and ``parse(key)``
+    the fields of one of them
+
+    patterns of plain ``{name}`` fields only are turned into a
+    ``%(name)s`` format, a single C level call, the others keep going
+    through :meth:`str.format`
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._parsed = parsed = list(Formatter().parse(pattern))
+        self.fields = tuple(f for _, f, _, _ in parsed if f is not None)
+        simple = all(
+            f is None or (_FIELD_NAME.match(f) and not spec and not conversion)
+            for _, f, spec, conversion in parsed)
+        if simple:
+            self.format = ''.join(
+                literal.replace('%', '%%') +
+                ('%%(%s)s' % f if f is not None else '')
+                for literal, f, _, _ in parsed).__mod__
+        else:
+            self.format = lambda mapping: pattern.format(**mapping)
+
+        regex = []
+        for literal, f, _, _ in parsed:
+            regex.append(re.escape(literal))
+            if f is None:
+                continue
+            if not _FIELD_NAME.match(f):
+                regex.append('.+?')
+            elif '(?P<%s>' % f in regex:
+                regex.append('(?P=%s)' % f)
+            else:
+                regex.append('(?P<%s>' % f)
+                regex.append('.+?)')
+        self._regex = re.compile(''.join(regex) + '$', re.DOTALL)
+
+    def __repr__(self):
+        return '<KeyTemplate %r>' % self.pattern
+
+    def glob(self, mapping=None):
+        """fields missing from ``mapping`` match anything"""
+        mapping = mapping or {}
+        parts = []
+        for literal, f, spec, conversion in self._parsed:
+            parts.append(_GLOB_SPECIAL.sub(r'\\\1', literal))
+            if f is None:
+                continue
+            if f in mapping and not spec and not conversion:
+                parts.append(_GLOB_SPECIAL.sub(r'\\\1', '%s' % mapping[f]))
+            else:
+                parts.append('*')
+        return ''.join(parts)
+
+    def parse(self, key):
+        """the plain fields of ``key``, ``None`` when not built by this
+        template
+        """
+        match = self._regex.match(key)
+        if match is not None:
+            return match.groupdict()
+
+
+def _read_command(value_type, key, attrs):
+    if value_type == 'set':
+        return ('smembers', key)
+    if not attrs:
+        return ('hgetall', key)
+    if len(attrs) == 1:
+        return ('hget', key, attrs[0])
+    return ('hmget', key) + attrs
+
+
+def _read_many(db, value_type, keys, attrs):
+    """values of ``keys``: one MGET for json values, one pipeline of per
+    key reads for hash and set values
+    """
+    if value_type == 'json':
+        return db._execute(
+            [('mget',) + tuple(keys)],
+            lambda replies: [_decode_json(v, attrs) for v in replies[-1]])
+    return db._execute([_read_command(value_type, key, attrs)
+                        for key in keys],
+                       lambda replies: replies,
+                       transaction=False)
+
+
+def _call_command(client, command):
+    """``command`` is (client method name, args...), or (callable, args...)
+    called with the client first
+    """
+    if callable(command[0]):
+        return command[0](client, *command[1:])
+    return getattr(client, command[0])(*command[1:])
 
 
 class KeyValueDBMeta(type):
@@ -21,6 +171,19 @@ class KeyValueDBMeta(type):
        interpolated with user provided value while getting or setting the value
     4. the second one is data type, currently 3 types
        supported: (``hash``, ``set``, ``json (string)``)
+    5. optionally followed by the allowed fields and a validator, and for
+       ``json`` a :class:`codec.Codec`, defaulting to ``__codec__`` of
+       the class
+
+    generated methods do not talk to the client directly, they hand the
+    redis commands to ``self._execute`` with a function parsing the
+    replies, so the same methods also queue into a
+    :class:`KeyValueDBPipeline`
+
+    every key also gets ``<id>_many`` reading many bindings at once,
+    ``iter_<id>`` walking all of its keys, and ``json`` keys get
+    ``merge_<id>``, ``incr_<id>`` and ``unset_<id>`` updating some fields
+    in place
     """
 
     @staticmethod
@@ -28,49 +191,89 @@ class KeyValueDBMeta(type):
         if value_type == 'set':
             def getter(self, **kwargs):
                 key = self.make_key(key_id, kwargs)
-                return self.client.smember(key)
+                return self._execute([('smembers', key)], cached=True)
         elif value_type == 'hash':
             def getter(self, *attrs, **kwargs):
-                key = self.make_key(key_id, attrs, kwargs)
-                if attrs:
-                    if len(attrs) == 1:
-                        return self.client.hget(key, attrs[0])
-                    else:
-                        return self.client.hmget(key, *attrs)
+                key = self.make_key(key_id, kwargs)
+                if not attrs:
+                    return self._execute([('hgetall', key)], cached=True)
+                if len(attrs) == 1:
+                    return self._execute([('hget', key, attrs[0])],
+                                         cached=True)
+                return self._execute([('hmget', key) + attrs], cached=True)
         elif value_type == 'json':
             def getter(self, *attrs, **kwargs):
                 key = self.make_key(key_id, kwargs)
-                value_json = self.client.get(key)
-                if not value_json:
-                    return
-                value_dict = json.loads(value_json)
-                if attrs:
-                    value_attrs = {}
-                    for a in value_attrs:
-                        if a in attrs:
-                            value_attrs[a] = value_dict[a]
-                    return value_attrs
-                return value_dict
+                return self._execute(
+                    [('get', key)],
+                    lambda replies: _decode_json(replies[-1], attrs),
+                    cached=True)
         return getter
 
     @staticmethod
-    def make_setter(key_id, value_type, fields=(), validator=None):
+    def make_bulk_getter(key_id, value_type):
+        """getter of many bindings at once, e.g.
+        ``db.app_service_info_many([{'app': a} for a in apps], 'port')``,
+        returning values in the order of ``bindings``: one MGET for json
+        values, one pipeline of per key reads for hash and set values
+        """
+        def bulk_getter(self, bindings, *attrs):
+            if not bindings:
+                return []
+            keys = [self.make_key(key_id, b) for b in bindings]
+            return _read_many(self, value_type, keys, attrs)
+        return bulk_getter
+
+    @staticmethod
+    def make_iterator(key_id, value_type):
+        """iterator of ``(fields, value)`` of every existing key, e.g.
+        ``db.iter_app_service_info('port')`` yields
+        ``({'app': 'app1'}, {'port': 8000})``; bound fields restrict the
+        keys walked
+
+        keys are listed by SCAN MATCH and their values read ``count`` at a
+        time as in ``<id>_many``, so redis is never blocked and memory
+        stays constant; like SCAN, a key may be seen more than once, and
+        one deleted meanwhile comes with an empty value
+        """
+        def iterator(self, *attrs, **kwargs):
+            count = kwargs.pop('count', 100)
+            template = (self._key_templates.get(key_id) or
+                        self._get_key_template(key_id))
+            match = template.glob(self._get_key_pattern_value(kwargs))
+            keys = self.client.scan_iter(match=match, count=count)
+            while True:
+                batch = list(islice(keys, count))
+                if not batch:
+                    return
+                values = self._wait(
+                    _read_many(self, value_type, batch, attrs))
+                for key, value in zip(batch, values):
+                    yield template.parse(key), value
+        return iterator
+
+    @staticmethod
+    def make_setter(key_id, value_type, fields=(), validator=None,
+                    codec=JSON):
         if value_type == 'set':
             def setter(self, *values, **kwargs):
                 if validator:
                     validator.validate(*values)
                 key = self.make_key(key_id, kwargs)
-                self.client.delete(key)
-                return self.client.sadd(key, *values)
+                return self._execute([('delete', key),
+                                      ('sadd', key) + values],
+                                     writes=(key,))
         elif value_type == 'hash':
             def setter(self, value, field=None, **kwargs):
                 if validator:
                     validator.validate(value)
                 key = self.make_key(key_id, kwargs)
                 if isinstance(value, dict):
-                    return self.client.hmset(key, value)
+                    return self._execute([('hmset', key, value)],
+                                         writes=(key,))
                 elif field is not None:
-                    return self.client.hset(key, field, value)
+                    return self._execute([('hset', key, field, value)],
+                                         writes=(key,))
                 else:
                     raise ValueError('unable to set (%r, %r) for %r '
                                      % (field, value, key))
@@ -80,50 +283,112 @@ class KeyValueDBMeta(type):
                 if isinstance(value, dict):
                     if validator:
                         validator.validate(value)
-                    value_json = json.dumps(value)
-                    return self.client.set(key, value_json)
+                    return self._execute([('set', key, codec.encode(value))],
+                                         writes=(key,))
                 elif field is not None:
                     if fields and field not in fields:
                         raise ValueError('invalid field: {!r}'.format(field))
                     value_obj = json.loads(value)
-                    orig_value_json = self.client.get(key)
-                    if orig_value_json:
-                        orig_value_dict = json.loads(orig_value_json)
-                        new_value_json = copy.deepcopy(orig_value_dict)
-                        new_value_json[field] = value_obj
-                    else:
-                        new_value_json = {field: value_obj}
                     if validator:
-                        validator.validate(new_value_json)
-                    return self.client.set(key, json.dumps(new_value_json))
+                        validator.validate({field: value_obj}, update=True)
+                    return self._update_json(
+                        key, codec, lambda replies: bool(replies[-1]),
+                        'set', field, json.dumps(value_obj))
                 else:
                     raise ValueError('unable to set (%r, %r) for %r '
                                      % (field, value, key))
         return setter
 
+    @staticmethod
+    def make_json_updaters(key_id, fields=(), validator=None, codec=JSON):
+        """partial updates of a json value, each one atomic: a WATCH/MULTI
+        loop reading, updating and writing the whole value back in python,
+        retried when another client writes the key meanwhile
+        """
+        def check_fields(*names):
+            for field in names:
+                if fields and field not in fields:
+                    raise ValueError('invalid field: {!r}'.format(field))
+
+        def merge(self, value, **kwargs):
+            check_fields(*value)
+            if validator:
+                validator.validate(value, update=True)
+            key = self.make_key(key_id, kwargs)
+            return self._update_json(key, codec,
+                                     lambda replies: bool(replies[-1]),
+                                     'merge', json.dumps(value))
+
+        def incr(self, field, amount=1, **kwargs):
+            check_fields(field)
+            key = self.make_key(key_id, kwargs)
+            return self._update_json(key, codec,
+                                     lambda replies: json.loads(replies[-1]),
+                                     'incr', field, amount)
+
+        def unset(self, field, **kwargs):
+            check_fields(field)
+            key = self.make_key(key_id, kwargs)
+            return self._update_json(key, codec,
+                                     lambda replies: bool(replies[-1]),
+                                     'unset', field)
+
+        return {
+            'merge_' + key_id: merge,
+            'incr_' + key_id: incr,
+            'unset_' + key_id: unset,
+        }
+
     def __new__(cls, name, bases, dict_):
         cls_ = super(KeyValueDBMeta, cls).__new__(cls, name, bases, dict_)
+        # namespace applied once here instead of on every call
+        namespace = getattr(cls_, '__namespace__', '')
+        cls_._key_templates = dict(
+            (k, KeyTemplate(namespace + ':' + v[0]))
+            for k, v in dict_['KEYS'].iteritems()) if namespace else {}
+        # generated method name -> (key id, op), for the metrics
+        cls_._generated_methods = dict(
+            getattr(cls_, '_generated_methods', {}))
         for k, v in dict_['KEYS'].iteritems():
+            codec = getattr(cls_, '__codec__', JSON)
             try:
-                _, value_type, fields, validator = v
+                _, value_type, fields, validator, codec = v
             except ValueError:
                 try:
-                    _, value_type, validator = v
-                    fields = ()
+                    _, value_type, fields, validator = v
                 except ValueError:
-                    _, value_type = v
-                    fields = ()
-                    validator = None
-            getter = cls_.make_getter(k, value_type)
-            if k in cls_.__dict__:
-                raise ValueError('%r already defined in %r' % (k, cls_))
-            setattr(cls_, k, getter)
-            setter_name = 'set_' + k
-            if setter_name in cls_.__dict__:
-                raise ValueError('%r already defined in %r'
-                                 % (setter_name, cls_))
-            setter = cls_.make_setter(k, value_type, fields, validator)
-            setattr(cls_, setter_name, setter)
+                    try:
+                        _, value_type, validator = v
+                        fields = ()
+                    except ValueError:
+                        _, value_type = v
+                        fields = ()
+                        validator = None
+            methods = {
+                k: cls_.make_getter(k, value_type),
+                k + '_many': cls_.make_bulk_getter(k, value_type),
+                'iter_' + k: cls_.make_iterator(k, value_type),
+                'set_' + k: cls_.make_setter(
+                    k, value_type, fields, validator, codec),
+            }
+            if value_type == 'json':
+                methods.update(
+                    cls_.make_json_updaters(k, fields, validator, codec))
+            for method_name, method in methods.iteritems():
+                if method_name in cls_.__dict__:
+                    raise ValueError('%r already defined in %r'
+                                     % (method_name, cls_))
+                method.__name__ = method_name
+                setattr(cls_, method_name, method)
+                if method_name == k:
+                    op = 'get'
+                elif method_name == k + '_many':
+                    op = 'get_many'
+                else:
+                    # set, merge, incr, unset or iter
+                    op = method_name[:-len(k) - 1]
+                if op != 'iter':
+                    cls_._generated_methods[method_name] = (k, op)
         return cls_
 
 
@@ -139,6 +404,9 @@ class BaseKeyValueDB(object):
        domain, e.g. ``my:domain:cluster``, ``my:domain:cluster:somecluster``
     3. key binding with :class:`KeyBindingMixin`, i.e. bind key
        pattern to a value
+    4. sharded over several redis given a list of urls, see
+       :class:`sharding.ShardedRedis`; a ``{{{app}}}`` in a key pattern
+       becomes a hash tag keeping every key of an app on the same shard
 
     Usage::
 
@@ -157,14 +425,209 @@ class BaseKeyValueDB(object):
         db.set_app_service_info({'port': 8000, 'worker_num': 8})
         db.app_service_info()
         db.app_service_info('port')
+
+        # one round trip for all of them
+        with db.pipeline() as p:
+            f1 = p.app_service_info(app='app1')
+            f2 = p.set_apps('app1', 'apptwo')
+        f1.result()
     """
     __metaclass__ = KeyValueDBMeta
 
     __namespace__ = ''
+    __codec__ = JSON
+    # how setters tell the read caches of other processes about their
+    # writes, see :class:`ReadCache`; by default only a db with a read
+    # cache does, classes whose readers cache set ``channel`` so that
+    # every writer publishes
+    __invalidation__ = None
     KEYS = {}
 
+    read_cache = None
+    metrics = None
+
     def __init__(self, url):
-        self.client = Redis.from_url(url)
+        if isinstance(url, (list, tuple)):
+            self.client = ShardedRedis(url)
+        else:
+            self.client = Redis.from_url(url)
+
+    def _execute(self, commands, parse=None, transaction=True, cached=False,
+                 writes=()):
+        """run ``commands``, tuples of (client method name, args...), and
+        return ``parse(replies)`` or the last reply; several commands are
+        sent in one round trip, in MULTI/EXEC if ``transaction``
+
+        a ``cached`` read of one key may be served by the read cache,
+        ``writes`` are the keys written, dropped from the read caches
+        """
+        cache = self.read_cache
+        if cached and cache is not None:
+            command = commands[0]
+            reply = cache.get(command[1], command)
+            if reply is MISSING:
+                reply = _call_command(self.client, command)
+                cache.put(command[1], command, reply)
+            replies = [reply]
+        else:
+            n = len(commands)
+            if writes:
+                commands = commands + self._invalidate(writes)
+            if len(commands) == 1:
+                replies = [_call_command(self.client, commands[0])]
+            else:
+                pipe = self.client.pipeline(transaction=transaction)
+                for command in commands:
+                    _call_command(pipe, command)
+                replies = pipe.execute()[:n]
+        if parse is None:
+            return replies[-1]
+        return parse(replies)
+
+    def _wait(self, result):
+        """the value of ``result``, returned by ``_execute``"""
+        return result
+
+    def _when_done(self, result, callback):
+        """``callback(error)`` once ``result``, returned by a generated
+        method, is done
+        """
+        callback(False)
+
+    def _update_json(self, key, codec, parse, op, *args):
+        """partial update of the json value of ``key``, ``op`` and ``args``
+        as in :func:`_apply_json_update`
+
+        done in python rather than by a lua script, as redis cjson turns
+        empty lists into objects and rounds integers to 14 digits in the
+        fields left untouched too; this takes two round trips, WATCH and
+        GET then MULTI/SET/EXEC, retried until no other client wrote the
+        key in between
+        """
+        client = self.client
+        if isinstance(client, ShardedRedis):
+            client = client.get_shard(key)
+        with client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    value = pipe.get(key)
+                    if not value and op == 'unset':
+                        return parse([0])
+                    doc = decode_value(value) if value else {}
+                    reply = _apply_json_update(doc, op, *args)
+                    pipe.multi()
+                    pipe.set(key, codec.encode(doc))
+                    for command in self._invalidate((key,)):
+                        _call_command(pipe, command)
+                    pipe.execute()
+                    return parse([reply])
+                except WatchError:
+                    continue
+
+    def _invalidate(self, keys):
+        """drop the written ``keys`` from the read cache of this process,
+        return the commands telling the other processes to do so; in
+        ``channel`` invalidation they are published even without a local
+        read cache, as other processes may have one
+        """
+        cache = self.read_cache
+        if cache is not None:
+            cache.drop(*keys)
+            invalidation = cache.invalidation
+        else:
+            invalidation = self.__invalidation__
+        if invalidation == 'channel':
+            channel = invalidation_channel(self.namespace)
+            return [('publish', channel, key) for key in keys]
+        return []
+
+    def enable_read_cache(self, maxsize=10000, ttl=5, invalidation=None):
+        """cache the replies of generated getters in this process, see
+        :class:`ReadCache`, ``invalidation`` defaults to
+        ``__invalidation__``, else ``channel``
+        """
+        self.disable_read_cache()
+        self.read_cache = ReadCache(
+            self.client, self.namespace, maxsize, ttl,
+            invalidation or self.__invalidation__ or 'channel')
+        self.read_cache.start()
+        return self.read_cache
+
+    def disable_read_cache(self):
+        if self.read_cache is not None:
+            self.read_cache.stop()
+            self.read_cache = None
+
+    def enable_metrics(self, metrics=None):
+        """record calls, latency, payload bytes and errors of the
+        generated methods of this db into ``metrics``, a new
+        :class:`metrics.KeyMetrics` by default
+
+        instrumented methods are set on the instance and dropped by
+        :meth:`disable_metrics`, so there is no overhead while disabled;
+        calls queued in pipelines and ``iter_<id>`` are not recorded, calls
+        of :class:`async_kvdb.AsyncBaseKeyValueDB` are once their greenlet
+        is done
+        """
+        self.disable_metrics()
+        if metrics is None:
+            metrics = KeyMetrics(self.namespace)
+        self.metrics = metrics
+        # [bytes read, bytes written] of the call in progress in this
+        # thread, handed to the parse function of each command as the
+        # replies may be parsed in another greenlet
+        local = threading.local()
+        execute = self._execute
+
+        def counting_execute(commands, parse=None, *args, **kwargs):
+            counters = getattr(local, 'counters', None)
+            if counters is None:
+                return execute(commands, parse, *args, **kwargs)
+            counters[1] += sum(payload_size(c[2:]) for c in commands)
+
+            def counting_parse(replies):
+                counters[0] += payload_size(replies)
+                return replies[-1] if parse is None else parse(replies)
+            return execute(commands, counting_parse, *args, **kwargs)
+
+        def instrument(method, key_id, op):
+            def instrumented(*args, **kwargs):
+                counters = local.counters = [0, 0]
+                start = time.time()
+
+                def record(error):
+                    metrics.record(key_id, op, time.time() - start,
+                                   counters[0], counters[1], error)
+                try:
+                    result = method(*args, **kwargs)
+                except Exception:
+                    record(True)
+                    raise
+                finally:
+                    local.counters = None
+                self._when_done(result, record)
+                return result
+            instrumented.__name__ = method.__name__
+            return instrumented
+
+        self._execute = counting_execute
+        for name, (key_id, op) in self._generated_methods.iteritems():
+            setattr(self, name, instrument(getattr(self, name), key_id, op))
+
+    def disable_metrics(self):
+        if self.metrics is None:
+            return
+        for name in self._generated_methods:
+            self.__dict__.pop(name, None)
+        self.__dict__.pop('_execute', None)
+        self.metrics = None
+
+    def pipeline(self, transaction=False):
+        """queue generated methods into one redis pipeline, see
+        :class:`KeyValueDBPipeline`
+        """
+        return KeyValueDBPipeline(self, transaction)
 
     @property
     def namespace(self):
@@ -187,9 +650,298 @@ class BaseKeyValueDB(object):
     def _get_full_key_pattern(self, id_):
         return self.namespace + ':' + self.KEYS[id_][0]
 
+    def _get_key_pattern_value(self, kwargs):
+        return kwargs
+
+    def _get_key_template(self, id_):
+        # not compiled when the class had no namespace yet
+        return KeyTemplate(self._get_full_key_pattern(id_))
+
     def make_key(self, id_, kwargs):
-        full_key_pat = self._get_full_key_pattern(id_)
-        return full_key_pat.format(**kwargs)
+        template = (self._key_templates.get(id_) or
+                    self._get_key_template(id_))
+        return template.format(kwargs)
+
+
+def invalidation_channel(namespace):
+    return namespace + ':__invalidate__'
+
+
+class ReadCache(object):
+    """
+    Per process read-through cache of the replies of generated getters,
+    at most ``maxsize`` redis keys kept for ``ttl`` seconds, least
+    recently used first out.
+
+    Generated setters drop the keys they write, locally right away and in
+    the other processes through ``invalidation``:
+
+    * ``channel``: setters publish the key on ``<namespace>:__invalidate__``
+      in the same round trip as the write; a db without a read cache
+      publishes only if its class sets ``__invalidation__ = 'channel'``,
+      which every writer of keys cached elsewhere should do
+    * ``keyspace``: keyspace notifications of the server, which also see
+      writes of raw clients, needs ``notify-keyspace-events`` to include
+      ``K`` and the written types, e.g. ``K$hs``
+
+    A listener thread applies the invalidations; when its connection
+    drops everything is dropped, so values are never staler than ``ttl``.
+    """
+
+    def __init__(self, client, namespace, maxsize=10000, ttl=5,
+                 invalidation='channel'):
+        if invalidation not in ('channel', 'keyspace'):
+            raise ValueError('invalid invalidation: {!r}'.format(invalidation))
+        self.client = client
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.invalidation = invalidation
+        self.channel = invalidation_channel(namespace)
+        self.hits = 0
+        self.misses = 0
+        # key -> {command: (expire at, reply)}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._pubsub = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def get(self, key, command):
+        with self._lock:
+            replies = self._entries.get(key)
+            if replies is not None and command in replies:
+                expire_at, reply = replies[command]
+                if expire_at > time.time():
+                    self.hits += 1
+                    # move to the most recently used end
+                    self._entries[key] = self._entries.pop(key)
+                    if isinstance(reply, (dict, list, set)):
+                        reply = copy.copy(reply)
+                    return reply
+                del replies[command]
+            self.misses += 1
+            return MISSING
+
+    def put(self, key, command, reply):
+        with self._lock:
+            replies = self._entries.pop(key, None)
+            if replies is None:
+                replies = {}
+                while len(self._entries) >= self.maxsize:
+                    self._entries.popitem(last=False)
+            self._entries[key] = replies
+            if isinstance(reply, (dict, list, set)):
+                reply = copy.copy(reply)
+            replies[command] = (time.time() + self.ttl, reply)
+
+    def drop(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+    def _subscribe(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        if self.invalidation == 'channel':
+            pubsub.subscribe(self.channel)
+        else:
+            if isinstance(self.client, ShardedRedis):
+                db = '*'
+            else:
+                db = self.client.connection_pool.connection_kwargs.get('db', 0)
+            pubsub.psubscribe('__keyspace@%s__:%s:*' % (db, self.namespace))
+        return pubsub
+
+    def _listen(self):
+        prefix_len = len('__keyspace@__:')
+        while not self._stopped.is_set():
+            try:
+                if self._pubsub is None:
+                    self._pubsub = self._subscribe()
+                message = self._pubsub.get_message(timeout=1)
+            except ConnectionError:
+                # invalidations may have been missed
+                self.clear()
+                self._pubsub = None
+                self._stopped.wait(1)
+                continue
+            if not message:
+                continue
+            if self.invalidation == 'channel':
+                self.drop(message['data'])
+            else:
+                channel = message['channel']
+                self.drop(channel[channel.index(':', prefix_len) + 1:])
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+        self.clear()
+
+
+class PipelineFuture(object):
+    """result of a generated method called in a pipeline, resolved when
+    the pipeline is executed
+    """
+    _pending = object()
+
+    def __init__(self):
+        self._result = self._pending
+        self._exception = None
+
+    def done(self):
+        return self._result is not self._pending or self._exception is not None
+
+    def set_result(self, result):
+        self._result = result
+
+    def set_exception(self, exception):
+        self._exception = exception
+
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        if self._result is self._pending:
+            raise RuntimeError('pipeline not executed yet')
+        return self._result
+
+
+class KeyValueDBPipeline(object):
+    """
+    Generated getters and setters of the db queue their commands into one
+    redis pipeline (MULTI/EXEC if ``transaction``) instead of running
+    them, and return a :class:`PipelineFuture` resolved on exit::
+
+        with db.pipeline() as p:
+            for app, info in infos.iteritems():
+                p.set_app_service_info(info, app=app)
+            port = p.app_service_info('port', app='app1')
+        port.result()
+
+    partial json updates, ``merge_<id>``, ``incr_<id>``, ``unset_<id>`` and
+    ``set_<id>`` of one field, need their own WATCH/MULTI: on execution the
+    commands queued before one are sent, then it runs, then the commands
+    queued after it, so everything still applies in call order.  They can
+    not be part of a ``transaction`` pipeline.
+
+    everything else, e.g. key binding, is looked up on the db
+    """
+
+    def __init__(self, db, transaction=False):
+        self.db = db
+        self.transaction = transaction
+        # in call order, ('pipe', redis pipeline, its pending commands)
+        # and ('update', future, partial json update)
+        self._steps = []
+        self._new_pipe()
+
+    def _new_pipe(self):
+        self.client = self.db.client.pipeline(transaction=self.transaction)
+        self._pending = []
+        self._steps.append(('pipe', self.client, self._pending))
+
+    def __getattr__(self, name):
+        attr = getattr(type(self.db), name, None)
+        if getattr(attr, '__func__', None) is not None:
+            # rebind methods of the db, generated ones included, so that
+            # they call ``_execute`` of the pipeline
+            return attr.__func__.__get__(self, type(self))
+        return getattr(self.db, name)
+
+    def _execute(self, commands, parse=None, transaction=True, cached=False,
+                 writes=()):
+        n = len(commands)
+        if writes:
+            commands = commands + self.db._invalidate(writes)
+        for command in commands:
+            _call_command(self.client, command)
+        future = PipelineFuture()
+        self._pending.append((future, n, len(commands) - n, parse))
+        return future
+
+    def _update_json(self, key, codec, parse, op, *args):
+        if self.transaction:
+            raise ValueError('partial json updates can not run in a'
+                             ' transaction pipeline')
+        db = self.db
+        future = PipelineFuture()
+        self._steps.append(('update', future, lambda: db._wait(
+            db._update_json(key, codec, parse, op, *args))))
+        # commands queued from now on are sent after the update
+        self._new_pipe()
+        return future
+
+    def _execute_pipe(self, pipe, pending):
+        if not pending:
+            return
+        replies = pipe.execute(raise_on_error=False)
+        offset = 0
+        for future, n, n_extra, parse in pending:
+            command_replies = replies[offset:offset + n]
+            offset += n + n_extra
+            errors = [r for r in command_replies if isinstance(r, Exception)]
+            if errors:
+                future.set_exception(errors[0])
+                continue
+            try:
+                if parse is None:
+                    future.set_result(command_replies[-1])
+                else:
+                    future.set_result(parse(command_replies))
+            except Exception as e:
+                future.set_exception(e)
+
+    def execute(self):
+        steps, self._steps = self._steps, []
+        self._new_pipe()
+        for kind, a, b in steps:
+            if kind == 'pipe':
+                self._execute_pipe(a, b)
+                continue
+            try:
+                a.set_result(b())
+            except Exception as e:
+                a.set_exception(e)
+
+    def reset(self):
+        for kind, pipe, _ in self._steps:
+            if kind == 'pipe':
+                pipe.reset()
+        self._steps = []
+        self._new_pipe()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
 
 
 class KeyBindingMixin(object):
@@ -225,13 +977,20 @@ class KeyBindingMixin(object):
         self._binding = {}
 
     def _get_key_pattern_value(self, kwargs):
-        binding = self.binding
-        binding.update(kwargs)
-        return binding
+        """the binding overridden by ``kwargs``, for this call only"""
+        binding = getattr(self, '_binding', None)
+        if not kwargs:
+            return binding or {}
+        if not binding:
+            return kwargs
+        value = binding.copy()
+        value.update(kwargs)
+        return value
 
     def make_key(self, id_, kwargs):
-        full_key_pat = self._get_full_key_pattern(id_)
-        return full_key_pat.format(**self._get_key_pattern_value(kwargs))
+        template = (self._key_templates.get(id_) or
+                    self._get_key_template(id_))
+        return template.format(self._get_key_pattern_value(kwargs))
 
 
 class Validator(object):
@@ -239,18 +998,33 @@ class Validator(object):
         self.schema = schema
 
     @abc.abstractmethod
-    def validate(self, value):
-        """ validate method"""
+    def validate(self, value, update=False):
+        """ validate method, ``update`` for a partial value whose missing
+        required fields are not checked"""
         return
 
 
 class DictValidator(Validator):
 
-    def validate(self, value):
-        v = cerberus.Validator(
-            schema=self.schema,
-            allow_unknown=True)
-        if not v.validate(value):
+    def __init__(self, schema=None):
+        super(DictValidator, self).__init__(schema)
+        # cerberus validators keep the document being validated, so one
+        # per thread
+        self._local = threading.local()
+
+    @property
+    def validator(self):
+        try:
+            return self._local.validator
+        except AttributeError:
+            v = self._local.validator = cerberus.Validator(
+                schema=self.schema,
+                allow_unknown=True)
+            return v
+
+    def validate(self, value, update=False):
+        v = self.validator
+        if not v.validate(value, update=update):
             raise cerberus.ValidationError(v.errors)
 
 
@@ -287,6 +1061,54 @@ class MyKeyValueDB(KeyBindingMixin, BaseKeyValueDB):
         if host:
             self.bind_key(host=host)
 
-db = MyKeyValueDB('redis:/localhost:6379', app='test')
-db.set_app_service_info({'app': 'test', 'port': 1234})
-print db.app_service_info()  # {u'app': u'test', u'port': 1234}
+
+if __name__ == '__main__':
+    # an in-process stand-in of redis
+    import fakeredis
+
+    class PipelineKeyValueDB(MyKeyValueDB):
+        KEYS = dict(
+            MyKeyValueDB.KEYS,
+            app_ports=('app:{app}:ports', 'hash'),
+        )
+
+    db = PipelineKeyValueDB('redis://localhost:6379', app='test')
+    db.client = fakeredis.FakeStrictRedis()
+    db.set_app_service_info({'app': 'test', 'port': 1234})
+    print db.app_service_info()  # {u'app': u'test', u'port': 1234}
+
+    # partial updates leave the other fields exactly as they were
+    untouched = {'tags': [], 'big': 12345678901234567, 'f': 0.1}
+    db.set_app_service_info(dict(untouched, app='test', port=1234))
+    db.set_app_service_info('1235', field='port')
+    db.merge_app_service_info({'port': 1236})
+    assert db.incr_app_service_info('port') == 1237
+    assert db.app_service_info() == dict(untouched, app='test', port=1237)
+    db.unset_app_service_info('port')
+    assert db.app_service_info() == dict(untouched, app='test')
+
+    # pipelines: futures resolve on exit, in queue order, each with the
+    # error of its own commands, partial updates in call order
+    db.client.set(db.make_key('app_ports', {'app': 'broken'}), 'not a hash')
+    with db.pipeline() as p:
+        first = p.set_app_service_info({'app': 'test', 'port': 10})
+        port = p.incr_app_service_info('port')
+        ports = p.set_app_ports({'http': 80})
+        broken = p.app_ports(app='broken')
+        p.set_app_service_info('20', field='port')
+        p.merge_app_service_info({'app_id': 7})
+        info = p.app_service_info()
+        http = p.app_ports('http')
+        assert not info.done()
+    assert all(f.done() for f in (first, port, ports, broken, info, http))
+    assert first.result() is True and ports.result() is True
+    assert port.result() == 11
+    assert info.result() == {'app': 'test', 'app_id': 7, 'port': 20}
+    assert http.result() == '80'
+    try:
+        broken.result()
+    except Exception as e:
+        assert 'WRONGTYPE' in str(e)
+    else:
+        raise AssertionError('error not set on its future')
+    print 'pipeline ok'
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Calls, latency histogram, payload bytes and errors per key id and
+operation of the generated methods, see
+:meth:`kvdb.BaseKeyValueDB.enable_metrics`::
+
+    db.enable_metrics()
+    ...
+    db.metrics.snapshot()['app_service_info']['get']['count']
+    print db.metrics.prometheus()
+"""
+
+import threading
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5)
+
+# fields of a stat
+COUNT, ERRORS, SECONDS, MAX_SECONDS, BYTES_READ, BYTES_WRITTEN, HISTOGRAM = \
+    range(7)
+
+
+def payload_size(value):
+    """approximate bytes of the strings in ``value``"""
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v)
+                   for k, v in value.iteritems())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(payload_size(v) for v in value)
+    return 0
+
+
+class KeyMetrics(object):
+
+    def __init__(self, namespace='', buckets=BUCKETS):
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        # (key id, op) -> stat
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, key_id, op, seconds, bytes_read=0, bytes_written=0,
+               error=False):
+        with self._lock:
+            stat = self._stats.get((key_id, op))
+            if stat is None:
+                stat = self._stats[(key_id, op)] = [
+                    0, 0, 0.0, 0.0, 0, 0, [0] * (len(self.buckets) + 1)]
+            stat[COUNT] += 1
+            if error:
+                stat[ERRORS] += 1
+            stat[SECONDS] += seconds
+            if seconds > stat[MAX_SECONDS]:
+                stat[MAX_SECONDS] = seconds
+            stat[BYTES_READ] += bytes_read
+            stat[BYTES_WRITTEN] += bytes_written
+            histogram = stat[HISTOGRAM]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[-1] += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """{key id: {op: stat dict}}, ``buckets`` maps each upper bound to
+        the number of calls that fast, as in prometheus
+        """
+        with self._lock:
+            stats = [(k, list(v), list(v[HISTOGRAM]))
+                     for k, v in self._stats.iteritems()]
+        snapshot = {}
+        for (key_id, op), stat, histogram in stats:
+            cumulative, buckets = 0, []
+            for bound, n in zip(self.buckets + (float('inf'),), histogram):
+                cumulative += n
+                buckets.append((bound, cumulative))
+            snapshot.setdefault(key_id, {})[op] = {
+                'count': stat[COUNT],
+                'errors': stat[ERRORS],
+                'seconds': stat[SECONDS],
+                'mean_seconds': stat[SECONDS] / stat[COUNT],
+                'max_seconds': stat[MAX_SECONDS],
+                'bytes_read': stat[BYTES_READ],
+                'bytes_written': stat[BYTES_WRITTEN],
+                'buckets': buckets,
+            }
+        return snapshot
+
+    def prometheus(self, prefix='kvdb'):
+        """the snapshot in the prometheus text exposition format"""
+        snapshot = self.snapshot()
+        rows = sorted((key_id, op, stat)
+                      for key_id, ops in snapshot.iteritems()
+                      for op, stat in ops.iteritems())
+        lines = []
+
+        def labels(key_id, op, **extra):
+            pairs = [('namespace', self.namespace), ('key_id', key_id),
+                     ('op', op)] + sorted(extra.items())
+            return '{%s}' % ','.join(
+                '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+                for name, value in pairs)
+
+        for name, field, help_ in (
+                ('calls_total', 'count', 'calls of generated methods'),
+                ('errors_total', 'errors', 'calls raising an error'),
+                ('read_bytes_total', 'bytes_read', 'bytes read from redis'),
+                ('written_bytes_total', 'bytes_written',
+                 'bytes written to redis')):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help_))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for key_id, op, stat in rows:
+                lines.append('%s_%s%s %s' % (
+                    prefix, name, labels(key_id, op), stat[field]))
+
+        name = prefix + '_latency_seconds'
+        lines.append('# HELP %s latency of generated methods' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for key_id, op, stat in rows:
+            for bound, n in stat['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket%s %d' % (
+                    name, labels(key_id, op, le=le), n))
+            lines.append('%s_sum%s %r' % (
+                name, labels(key_id, op), stat['seconds']))
+            lines.append('%s_count%s %d' % (
+                name, labels(key_id, op), stat['count']))
+        return '\n'.join(lines) + '\n'
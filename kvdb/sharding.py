@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+"""Redis client spreading keys over several redis instances
+
+Keys are routed through the consistent hash ring of ``hash/hashring.py``,
+adding or removing a url only moves the keys of its neighbours.  Like
+redis cluster, only the part between the first ``{`` and the next ``}``
+of a key is hashed when it is not empty, so ``app:{app1}:info`` and
+``app:{app1}:service_info`` live on the same shard.
+
+Commands of one key go to its shard, ``mget`` and pipelines are split
+per shard and the shards run in parallel.  Transactions are atomic per
+shard only.
+"""
+
+import os
+import sys
+import select
+from multiprocessing.pool import ThreadPool
+
+from redis import Redis
+
+try:
+    from hashring import HashRing
+except ImportError:
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, 'hash'))
+    from hashring import HashRing
+
+
+def hash_tag(key):
+    """the part of ``key`` deciding its shard"""
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class ShardedRedis(object):
+    """
+    a :class:`redis.Redis` look-alike for the commands of the generated
+    methods, one connection pool per url::
+
+        client = ShardedRedis(['redis://10.0.0.1:6379',
+                               'redis://10.0.0.2:6379'])
+        client.set('app:{app1}:info', '{}')
+        client.get_shard('app:{app1}:info')  # Redis of 10.0.0.x
+
+    pub/sub messages are published on the first shard and received from
+    all of them
+    """
+
+    def __init__(self, urls, weights=None, replicas=3, hash_fn='md5',
+                 **kwargs):
+        if not urls:
+            raise ValueError('no redis url')
+        self.urls = list(urls)
+        self.shards = [Redis.from_url(url, **kwargs) for url in self.urls]
+        self._clients = dict(zip(self.urls, self.shards))
+        self._indexes = dict((url, i) for i, url in enumerate(self.urls))
+        self.ring = HashRing(self.urls, weights, replicas, hash_fn)
+        # created lazily, a fork keeps none of the threads of the parent
+        self._thread_pool = None
+        self._pid = None
+
+    def __repr__(self):
+        return '<ShardedRedis %s>' % ', '.join(self.urls)
+
+    def get_shard_index(self, key):
+        return self._indexes[self.ring.get_node(hash_tag(key))]
+
+    def get_shard(self, key):
+        return self._clients[self.ring.get_node(hash_tag(key))]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(Redis, name):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            return getattr(self.get_shard(key), name)(key, *args, **kwargs)
+        command.__name__ = name
+        return command
+
+    @property
+    def _executor(self):
+        if self._pid != os.getpid():
+            self._thread_pool = ThreadPool(len(self.shards))
+            self._pid = os.getpid()
+        return self._thread_pool
+
+    def map_shards(self, func, args_list):
+        """``func(*args)`` for each item of ``args_list``, in parallel"""
+        if len(args_list) == 1:
+            return [func(*args_list[0])]
+        calls = [self._executor.apply_async(func, args)
+                 for args in args_list]
+        return [call.get() for call in calls]
+
+    def mget(self, *keys):
+        groups = {}
+        for i, key in enumerate(keys):
+            groups.setdefault(self.get_shard_index(key), []).append(i)
+        shard_ids = list(groups)
+        values = [None] * len(keys)
+        results = self.map_shards(
+            lambda shard_id: self.shards[shard_id].mget(
+                *[keys[i] for i in groups[shard_id]]),
+            [(shard_id,) for shard_id in shard_ids])
+        for shard_id, result in zip(shard_ids, results):
+            for i, value in zip(groups[shard_id], result):
+                values[i] = value
+        return values
+
+    def delete(self, *keys):
+        return sum(self.get_shard(key).delete(key) for key in keys)
+
+    def scan_iter(self, match=None, count=None):
+        """keys of every shard, one shard after the other"""
+        for shard in self.shards:
+            for key in shard.scan_iter(match=match, count=count):
+                yield key
+
+    def publish(self, channel, message):
+        return self.shards[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return ShardedPubSub([shard.pubsub(**kwargs) for shard in self.shards])
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._thread_pool.close()
+        for shard in self.shards:
+            shard.connection_pool.disconnect()
+
+
+class ShardedPipeline(object):
+    """one pipeline per shard, replies come back in the order the
+    commands were queued
+    """
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self._pipes = {}
+        # per queued command, the shard index, or the indexes of the
+        # keys of an ``mget``
+        self._order = []
+
+    def _pipe(self, shard_id):
+        pipe = self._pipes.get(shard_id)
+        if pipe is None:
+            pipe = self._pipes[shard_id] = self.client.shards[
+                shard_id].pipeline(transaction=self.transaction)
+        return pipe
+
+    def get_shard(self, key):
+        """pipeline of the shard of ``key``, for one command"""
+        shard_id = self.client.get_shard_index(key)
+        self._order.append(shard_id)
+        return self._pipe(shard_id)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not hasattr(Redis, name):
+            raise AttributeError(name)
+
+        def command(key, *args, **kwargs):
+            getattr(self.get_shard(key), name)(key, *args, **kwargs)
+            return self
+        command.__name__ = name
+        return command
+
+    def mget(self, *keys):
+        shard_ids = []
+        for key in keys:
+            shard_id = self.client.get_shard_index(key)
+            self._pipe(shard_id).get(key)
+            shard_ids.append(shard_id)
+        self._order.append(shard_ids)
+        return self
+
+    def publish(self, channel, message):
+        self._order.append(0)
+        self._pipe(0).publish(channel, message)
+        return self
+
+    def execute(self, raise_on_error=True):
+        order, self._order = self._order, []
+        pipes, self._pipes = self._pipes, {}
+        shard_ids = list(pipes)
+        results = self.client.map_shards(
+            lambda shard_id: pipes[shard_id].execute(
+                raise_on_error=raise_on_error),
+            [(shard_id,) for shard_id in shard_ids])
+        replies = dict((shard_id, iter(result))
+                       for shard_id, result in zip(shard_ids, results))
+        return [[next(replies[i]) for i in shard_id]
+                if isinstance(shard_id, list) else next(replies[shard_id])
+                for shard_id in order]
+
+    def reset(self):
+        for pipe in self._pipes.itervalues():
+            pipe.reset()
+        self._pipes = {}
+        self._order = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.reset()
+
+
+class ShardedPubSub(object):
+    """the pub/sub connections of every shard read as one"""
+
+    def __init__(self, pubsubs):
+        self.pubsubs = pubsubs
+
+    def subscribe(self, *args, **kwargs):
+        for pubsub in self.pubsubs:
+            pubsub.subscribe(*args, **kwargs)
+
+    def psubscribe(self, *args, **kwargs):
+        for pubsub in self.pubsubs:
+            pubsub.psubscribe(*args, **kwargs)
+
+    def _read(self):
+        for pubsub in self.pubsubs:
+            message = pubsub.get_message()
+            if message:
+                return message
+
+    def get_message(self, timeout=0):
+        message = self._read()
+        if message is None and timeout:
+            socks = [pubsub.connection._sock for pubsub in self.pubsubs
+                     if pubsub.connection is not None]
+            select.select(socks, [], [], timeout)
+            message = self._read()
+        return message
+
+    def close(self):
+        for pubsub in self.pubsubs:
+            pubsub.close()
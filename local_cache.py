@@ -1,18 +1,234 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+# fields of a link in a circular doubly linked list
+PREV, NEXT, NAME, FREQ = 0, 1, 2, 3
 
 
 def clear_local_cache(local_cache):
     local_cache.__clear_local_cache__()
 
 
+def approximate_size(value):
+    """bytes of ``value`` and of the containers and strings in it"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += approximate_size(k) + approximate_size(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += approximate_size(v)
+    return size
+
+
+def _new_list():
+    root = []
+    root[:] = [root, root, None]
+    return root
+
+
+def _append(root, link):
+    last = root[PREV]
+    link[PREV], link[NEXT] = last, root
+    last[NEXT] = root[PREV] = link
+
+
+def _unlink(link):
+    prev, next_ = link[PREV], link[NEXT]
+    prev[NEXT] = next_
+    next_[PREV] = prev
+
+
+class LRUPolicy(object):
+    """names least recently used first
+
+    ``remove`` returns the number of uses of the name, given back to
+    ``add`` when it is set again
+    """
+
+    def __init__(self):
+        self.links = {}
+        self.sizes = {}
+        self.total_size = 0
+        self._root = _new_list()
+
+    def add(self, name, size, freq=0):
+        link = self.links[name] = [None, None, name]
+        _append(self._root, link)
+        self.sizes[name] = size
+        self.total_size += size
+
+    def touch(self, name):
+        link = self.links[name]
+        _unlink(link)
+        _append(self._root, link)
+
+    def remove(self, name):
+        _unlink(self.links.pop(name))
+        self.total_size -= self.sizes.pop(name)
+        return 0
+
+    def victim(self):
+        return self._root[NEXT][NAME]
+
+    def clear(self):
+        self.__init__()
+
+
+class LFUPolicy(LRUPolicy):
+    """names least frequently used first, least recently used first
+    among the same frequency: one list of names per frequency
+    """
+
+    def __init__(self):
+        super(LFUPolicy, self).__init__()
+        self._lists = {}
+        self._min_freq = 0
+
+    def _append(self, link, freq):
+        link[FREQ] = freq
+        root = self._lists.get(freq)
+        if root is None:
+            root = self._lists[freq] = _new_list()
+        _append(root, link)
+
+    def _unlink(self, link):
+        _unlink(link)
+        freq = link[FREQ]
+        root = self._lists[freq]
+        if root[NEXT] is root:
+            del self._lists[freq]
+            return True
+        return False
+
+    def add(self, name, size, freq=0):
+        link = self.links[name] = [None, None, name, None]
+        self._append(link, freq + 1)
+        if freq == 0:
+            self._min_freq = 1
+        elif freq < self._min_freq or self._min_freq not in self._lists:
+            self._min_freq = min(self._lists)
+        self.sizes[name] = size
+        self.total_size += size
+
+    def touch(self, name):
+        link = self.links[name]
+        freq = link[FREQ]
+        if self._unlink(link) and self._min_freq == freq:
+            self._min_freq = freq + 1
+        self._append(link, freq + 1)
+
+    def remove(self, name):
+        link = self.links.pop(name)
+        self._unlink(link)
+        self.total_size -= self.sizes.pop(name)
+        return link[FREQ]
+
+    def victim(self):
+        root = self._lists.get(self._min_freq)
+        if root is None:
+            # the least frequent names were removed, not evicted
+            self._min_freq = min(self._lists)
+            root = self._lists[self._min_freq]
+        return root[NEXT][NAME]
+
+
+EVICTION_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+}
+
+
+class _Flight(object):
+    """a ``get_data`` in progress, waited for by the other callers"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exc_info = None
+
+    def set_result(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class _NoLock(object):
+    """the lock of a cache only set by the threads reading it"""
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_NO_LOCK = _NoLock()
+
+
 class LocalCache(object):
-    __slots__ = ('__storage__',)
+    """
+    values of ``get_data(name)`` cached for ``cache_time`` seconds
+
+    at most ``max_entries`` names and about ``max_bytes`` bytes, as
+    measured by ``get_size``, are kept when set, the ``eviction`` policy
+    (``lru`` or ``lfu``) choosing the names dropped to make room; a value
+    larger than ``max_bytes`` is returned but not cached
+
+    with ``single_flight``, callers missing the same name at the same
+    time wait for the ``get_data`` of the first one instead of running
+    their own; with ``stale_while_revalidate`` seconds, an expired value
+    is still returned for that long while one of ``refresh_workers``
+    background threads reloads it; names are then set from several
+    threads, so the ``eviction`` policy is kept under a lock
+    """
+    __slots__ = ('__storage__', '__policy__', '__lock__', '__flights__',
+                 '__flights_lock__', '__refresher__', '__pid__')
     cache_time = 0
+    max_entries = 0
+    max_bytes = 0
+    eviction = 'lru'
+    single_flight = False
+    stale_while_revalidate = 0
+    refresh_workers = 4
 
     def __init__(self):
         object.__setattr__(self, '__storage__', {})
+        if self.max_entries or self.max_bytes:
+            policy = EVICTION_POLICIES[self.eviction]()
+        else:
+            policy = None
+        object.__setattr__(self, '__policy__', policy)
+        # guards the policy, and the storage along with it, when
+        # set by loaders of other threads
+        if policy is not None and (
+                self.single_flight or self.stale_while_revalidate):
+            lock = threading.Lock()
+        else:
+            lock = None
+        object.__setattr__(self, '__lock__', lock)
+        self._reset_flights()
+
+    def _reset_flights(self):
+        # name -> _Flight
+        object.__setattr__(self, '__flights__', {})
+        object.__setattr__(self, '__flights_lock__', threading.Lock())
+        object.__setattr__(self, '__refresher__', None)
+        object.__setattr__(self, '__pid__', os.getpid())
 
     def get_cache_time(self):
         return self.cache_time
@@ -20,39 +236,195 @@ class LocalCache(object):
     def get_data(self, name):
         return 1
 
+    def get_data_many(self, names):
+        """{name: value} of ``names``, names left out are loaded by
+        ``get_data``; override it to load them all at once
+        """
+        return {}
+
+    def get_size(self, name, value):
+        return approximate_size(name) + approximate_size(value)
+
     def _set_cache(self, name, value):
-        storage = self.__storage__
+        with self.__lock__ or _NO_LOCK:
+            self._store(self.__storage__, self.__policy__, name, value,
+                        self.max_entries, self.max_bytes)
+
+    def _store(self, storage, policy, name, value, max_entries, max_bytes):
         ts = time.time() + self.get_cache_time()
+        if policy is not None:
+            freq = 0
+            if name in storage:
+                freq = policy.remove(name)
+                del storage[name]
+            size = self.get_size(name, value) if max_bytes else 0
+            if max_bytes and size > max_bytes:
+                return
+            # make room for one more name of ``size``
+            while storage and (
+                    max_entries and len(storage) >= max_entries or
+                    max_bytes and policy.total_size + size > max_bytes):
+                victim = policy.victim()
+                policy.remove(victim)
+                del storage[victim]
+            policy.add(name, size, freq)
         storage[name] = (ts, value)
 
+    def _touch(self, name):
+        """count a use of ``name``, if the cache is bounded"""
+        policy = self.__policy__
+        if policy is None:
+            return
+        lock = self.__lock__
+        if lock is None:
+            policy.touch(name)
+            return
+        with lock:
+            # may have been evicted by another thread meanwhile
+            if name in policy.links:
+                policy.touch(name)
+
+    def _remove(self, name):
+        """drop ``name``, return whether it was cached"""
+        policy = self.__policy__
+        if policy is None:
+            return self.__storage__.pop(name, None) is not None
+        with self.__lock__ or _NO_LOCK:
+            if self.__storage__.pop(name, None) is None:
+                return False
+            policy.remove(name)
+            return True
+
     def clear(self, name):
-        self.__storage__[name] = (0, 0)
+        self._remove(name)
 
     def __clear_local_cache__(self):
-        self.__storage__.clear()
+        with self.__lock__ or _NO_LOCK:
+            self.__storage__.clear()
+            if self.__policy__ is not None:
+                self.__policy__.clear()
 
     def __iter__(self):
         return iter(self.__storage__.items())
 
-    def __getattr__(self, name):
-        storage = self.__storage__
+    def _start_flight(self, name):
+        """(flight, True) when the caller has to load ``name`` itself,
+        (flight, False) when it is already being loaded, (None, False)
+        when it was loaded meanwhile
+        """
+        if self.__pid__ != os.getpid():
+            # a fork keeps neither the refresh threads of the parent nor
+            # the loaders of its flights
+            self._reset_flights()
+        with self.__flights_lock__:
+            flight = self.__flights__.get(name)
+            if flight is not None:
+                return flight, False
+            entry = self._entry(name)
+            if entry is not None and entry[0] >= time.time():
+                return None, False
+            flight = self.__flights__[name] = _Flight()
+            return flight, True
+
+    def _entry(self, name):
+        return self.__storage__.get(name)
+
+    def _run_flight(self, name, flight, loader=None):
         try:
-            ts, data = storage[name]
-            if ts < time.time():
-                data = self.get_data(name)
-                self._set_cache(name, data)
-        except KeyError:
-            data = self.get_data(name)
+            data = (loader or self.get_data)(name)
+            self._set_cache(name, data)
+            flight.set_result(data)
+        except Exception:
+            flight.set_exc_info(sys.exc_info())
+        finally:
+            with self.__flights_lock__:
+                del self.__flights__[name]
+        return flight
+
+    def _load(self, name, loader=None):
+        if not self.single_flight:
+            data = (loader or self.get_data)(name)
             self._set_cache(name, data)
+            return data
+        flight, leader = self._start_flight(name)
+        if flight is None:
+            entry = self._entry(name)
+            if entry is not None:
+                return entry[1]
+            # evicted right after being loaded
+            return self._load(name, loader)
+        if leader:
+            self._run_flight(name, flight, loader)
+        return flight.wait()
+
+    def _fresh_entry(self, name):
+        """the entry of ``name`` unless expired, counted as a use"""
+        entry = self.__storage__.get(name)
+        if entry is not None and entry[0] >= time.time():
+            self._touch(name)
+            return entry
+
+    def get_many(self, names):
+        """{name: value} of ``names``, the missing and expired ones loaded
+        by one ``get_data_many`` call
+        """
+        values, missing = {}, []
+        for name in names:
+            entry = self._fresh_entry(name)
+            if entry is not None:
+                values[name] = entry[1]
+                continue
+            entry = self._entry(name)
+            if entry is not None and \
+                    time.time() - entry[0] <= self.stale_while_revalidate:
+                self._refresh(name)
+                values[name] = entry[1]
+                continue
+            missing.append(name)
+        if missing:
+            loaded = self.get_data_many(missing)
+            for name in missing:
+                if name in loaded:
+                    value = loaded[name]
+                else:
+                    value = self.get_data(name)
+                self._set_cache(name, value)
+                values[name] = value
+        return values
+
+    def _refresh(self, name):
+        """reload ``name`` in the background, once at a time"""
+        flight, leader = self._start_flight(name)
+        if not leader:
+            return
+        refresher = self.__refresher__
+        if refresher is None:
+            with self.__flights_lock__:
+                refresher = self.__refresher__
+                if refresher is None:
+                    refresher = ThreadPool(self.refresh_workers)
+                    object.__setattr__(self, '__refresher__', refresher)
+        refresher.apply_async(self._run_flight, (name, flight))
+
+    def __getattr__(self, name):
+        entry = self.__storage__.get(name)
+        if entry is None:
+            return self._load(name)
+        ts, data = entry
+        if ts < time.time():
+            if time.time() - ts > self.stale_while_revalidate:
+                return self._load(name)
+            # the reload sets it again
+            self._refresh(name)
+        elif self.__policy__ is not None:
+            self._touch(name)
         return data
 
     def __setattr__(self, name, value):
         self._set_cache(name, value)
 
     def __delattr__(self, name):
-        try:
-            del self.__storage__[name]
-        except KeyError:
+        if not self._remove(name):
             raise AttributeError(name)
 
     def __getitem__(self, name):
@@ -65,6 +437,124 @@ class LocalCache(object):
         self.__delattr__(name)
 
 
+class _Segment(object):
+    __slots__ = ('lock', 'storage', 'policy')
+
+    def __init__(self, policy):
+        self.lock = threading.Lock()
+        self.storage = {}
+        self.policy = policy
+
+
+class ConcurrentLocalCache(LocalCache):
+    """
+    thread safe :class:`LocalCache`, names are spread by hash over
+    ``stripes`` segments each with its own lock, so threads reading
+    different names seldom wait for each other; ``max_entries`` and
+    ``max_bytes`` are split evenly between the segments, rounded down
+    but at least 1 each, so they are never exceeded unless lower than
+    ``stripes``
+
+    ``get_data`` runs outside of the locks and once at a time per name,
+    as with ``single_flight``
+    """
+    __slots__ = ('__segments__',)
+    single_flight = True
+    stripes = 16
+
+    def __init__(self):
+        super(ConcurrentLocalCache, self).__init__()
+        bounded = self.max_entries or self.max_bytes
+        object.__setattr__(self, '__segments__', [
+            _Segment(EVICTION_POLICIES[self.eviction]() if bounded else None)
+            for _ in xrange(self.stripes)])
+
+    def _segment(self, name):
+        return self.__segments__[hash(name) % self.stripes]
+
+    def _entry(self, name):
+        segment = self._segment(name)
+        with segment.lock:
+            return segment.storage.get(name)
+
+    def _set_cache(self, name, value):
+        segment = self._segment(name)
+        with segment.lock:
+            self._store(segment.storage, segment.policy, name, value,
+                        self._segment_limit(self.max_entries),
+                        self._segment_limit(self.max_bytes))
+
+    def _segment_limit(self, limit):
+        """share of one segment of ``limit``, 0 for no limit"""
+        if not limit:
+            return 0
+        return max(1, limit // self.stripes)
+
+    def _fresh_entry(self, name):
+        segment = self._segment(name)
+        with segment.lock:
+            entry = segment.storage.get(name)
+            if entry is not None and entry[0] >= time.time():
+                if segment.policy is not None:
+                    segment.policy.touch(name)
+                return entry
+
+    def get_or_load(self, name, loader=None):
+        """the cached value of ``name``, else ``loader(name)``,
+        ``get_data`` by default, run once for all the concurrent callers
+        and cached
+        """
+        entry = self._fresh_entry(name)
+        if entry is not None:
+            return entry[1]
+        return self._load(name, loader)
+
+    def clear(self, name):
+        segment = self._segment(name)
+        with segment.lock:
+            if segment.storage.pop(name, None) is not None and \
+                    segment.policy is not None:
+                segment.policy.remove(name)
+
+    def __clear_local_cache__(self):
+        for segment in self.__segments__:
+            with segment.lock:
+                segment.storage.clear()
+                if segment.policy is not None:
+                    segment.policy.clear()
+
+    def __iter__(self):
+        items = []
+        for segment in self.__segments__:
+            with segment.lock:
+                items.extend(segment.storage.items())
+        return iter(items)
+
+    def __getattr__(self, name):
+        segment = self.__segments__[hash(name) % self.stripes]
+        with segment.lock:
+            entry = segment.storage.get(name)
+            if entry is not None and entry[0] >= time.time():
+                if segment.policy is not None:
+                    segment.policy.touch(name)
+                return entry[1]
+        if entry is not None and \
+                time.time() - entry[0] <= self.stale_while_revalidate:
+            self._refresh(name)
+            return entry[1]
+        return self._load(name)
+
+    def __delattr__(self, name):
+        segment = self._segment(name)
+        with segment.lock:
+            try:
+                del segment.storage[name]
+            except KeyError:
+                raise AttributeError(name)
+            if segment.policy is not None:
+                segment.policy.remove(name)
+
+
 if __name__ == '__main__':
     import random
     LOCAL_CACHE_TIME = 5  # 5 seconds
@@ -103,3 +593,25 @@ if __name__ == '__main__':
     print '==========Local cache expired======'
     for i in range(5):
         print i, test_cache[i]
+
+    class BoundedLocalCache(TestLocalCache):
+        max_entries = 3
+        eviction = 'lfu'
+
+    bounded_cache = BoundedLocalCache()
+    print '==========Bounded local cache======='
+    for i in [0, 0, 1, 1, 2, 3, 4]:
+        bounded_cache[i]
+    print sorted(name for name, _ in bounded_cache)  # [0, 1, 4]
+
+    class BatchLocalCache(TestLocalCache):
+
+        def get_data_many(self, names):
+            print 'loading', names
+            return dict((name, random.randrange(1, 100)) for name in names)
+
+    batch_cache = BatchLocalCache()
+    print '==========Get many======='
+    batch_cache[0]
+    print batch_cache.get_many(range(5))  # loading [1, 2, 3, 4]
+    print batch_cache.get_many(range(5))
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+"""LocalCache shared by the processes forked after its creation
+
+Names and values are pickled into a shared anonymous mmap, ``slots``
+slots of ``slot_size`` bytes each, so a value loaded by one worker is
+read by all the others and held once per host.  A name can only live
+in the ``ways`` slots of its bucket; setting it in a full bucket takes
+the slot of an expired entry, else of the least recently used one.
+Values too large for a slot are returned but not cached.
+
+Buckets are guarded by ``stripes`` semaphores, ``multiprocessing.Lock``
+working across processes and threads alike.
+"""
+
+import os
+import mmap
+import time
+import struct
+import cPickle
+import multiprocessing
+
+from local_cache import LocalCache
+
+# expire at, last used, name hash, pickled name length, pickled value
+# length, followed by the pickled name and value
+HEADER = struct.Struct('<ddQII')
+LAST_USED = struct.Struct('<d')
+LAST_USED_OFFSET = 8
+
+_MASK64 = 0xffffffffffffffff
+
+
+def _dumps(value):
+    return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+
+class SharedLocalCache(LocalCache):
+    """
+    create it before forking the workers::
+
+        class ConfigCache(SharedLocalCache):
+            cache_time = 60
+            slots = 8192
+
+            def get_data(self, name):
+                return load_config(name)
+
+        config_cache = ConfigCache()
+        # fork, then config_cache.some_name in any worker
+
+    names have to be picklable, ``max_entries`` and ``max_bytes`` are
+    replaced by ``slots`` and ``slot_size``; ``single_flight`` and
+    ``stale_while_revalidate`` coordinate the threads of one process
+    only, all the processes then share the loaded value
+    """
+    __slots__ = ('__shm__', '__locks__')
+    slots = 4096
+    slot_size = 1024
+    ways = 8
+    stripes = 64
+
+    def __init__(self):
+        super(SharedLocalCache, self).__init__()
+        if self.slots % self.ways:
+            raise ValueError('slots has to be a multiple of ways')
+        if self.slot_size <= HEADER.size:
+            raise ValueError('slot_size has to be larger than %d'
+                             % HEADER.size)
+        object.__setattr__(self, '__shm__',
+                           mmap.mmap(-1, self.slots * self.slot_size))
+        object.__setattr__(self, '__locks__', [
+            multiprocessing.Lock() for _ in xrange(self.stripes)])
+
+    def _bucket(self, key):
+        """(name hash, first slot, lock) of the pickled name ``key``"""
+        key_hash = hash(key) & _MASK64
+        bucket = key_hash % (self.slots // self.ways)
+        return (key_hash, bucket * self.ways,
+                self.__locks__[bucket % self.stripes])
+
+    def _find(self, key, key_hash, first):
+        """slot of ``key``, or -1, under the lock of its bucket"""
+        shm, slot_size = self.__shm__, self.slot_size
+        for i in xrange(first, first + self.ways):
+            offset = i * slot_size
+            _, _, h, key_len, _ = HEADER.unpack_from(shm, offset)
+            start = offset + HEADER.size
+            if key_len and h == key_hash and \
+                    shm[start:start + key_len] == key:
+                return i
+        return -1
+
+    def _victim(self, first):
+        """free slot, else expired, else least recently used one"""
+        shm, slot_size = self.__shm__, self.slot_size
+        now = time.time()
+        victim, victim_used = first, None
+        for i in xrange(first, first + self.ways):
+            expire_at, last_used, _, key_len, _ = HEADER.unpack_from(
+                shm, i * slot_size)
+            if not key_len or expire_at < now:
+                return i
+            if victim_used is None or last_used < victim_used:
+                victim, victim_used = i, last_used
+        return victim
+
+    def _entry(self, name):
+        key = _dumps(name)
+        key_hash, first, lock = self._bucket(key)
+        shm = self.__shm__
+        with lock:
+            i = self._find(key, key_hash, first)
+            if i < 0:
+                return None
+            offset = i * self.slot_size
+            expire_at, _, _, key_len, value_len = HEADER.unpack_from(
+                shm, offset)
+            LAST_USED.pack_into(shm, offset + LAST_USED_OFFSET, time.time())
+            start = offset + HEADER.size + key_len
+            data = shm[start:start + value_len]
+        return expire_at, cPickle.loads(data)
+
+    def _fresh_entry(self, name):
+        entry = self._entry(name)
+        if entry is not None and entry[0] >= time.time():
+            return entry
+
+    def _set_cache(self, name, value):
+        key, data = _dumps(name), _dumps(value)
+        if HEADER.size + len(key) + len(data) > self.slot_size:
+            self.clear(name)
+            return
+        key_hash, first, lock = self._bucket(key)
+        shm = self.__shm__
+        expire_at = time.time() + self.get_cache_time()
+        with lock:
+            i = self._find(key, key_hash, first)
+            if i < 0:
+                i = self._victim(first)
+            offset = i * self.slot_size
+            start = offset + HEADER.size
+            shm[start:start + len(key) + len(data)] = key + data
+            HEADER.pack_into(shm, offset, expire_at, time.time(), key_hash,
+                             len(key), len(data))
+
+    def _remove(self, name):
+        key = _dumps(name)
+        key_hash, first, lock = self._bucket(key)
+        with lock:
+            i = self._find(key, key_hash, first)
+            if i >= 0:
+                HEADER.pack_into(self.__shm__, i * self.slot_size,
+                                 0, 0, 0, 0, 0)
+        return i >= 0
+
+    def clear(self, name):
+        self._remove(name)
+
+    def __clear_local_cache__(self):
+        shm, slot_size = self.__shm__, self.slot_size
+        for first in xrange(0, self.slots, self.ways):
+            with self.__locks__[(first // self.ways) % self.stripes]:
+                for i in xrange(first, first + self.ways):
+                    HEADER.pack_into(shm, i * slot_size, 0, 0, 0, 0, 0)
+
+    def __iter__(self):
+        shm, slot_size = self.__shm__, self.slot_size
+        items = []
+        for first in xrange(0, self.slots, self.ways):
+            with self.__locks__[(first // self.ways) % self.stripes]:
+                for i in xrange(first, first + self.ways):
+                    offset = i * slot_size
+                    expire_at, _, _, key_len, value_len = \
+                        HEADER.unpack_from(shm, offset)
+                    if key_len:
+                        start = offset + HEADER.size
+                        items.append((
+                            shm[start:start + key_len], expire_at,
+                            shm[start + key_len:
+                                start + key_len + value_len]))
+        return iter([(cPickle.loads(key), (expire_at, cPickle.loads(data)))
+                     for key, expire_at, data in items])
+
+    def __getattr__(self, name):
+        entry = self._entry(name)
+        if entry is not None:
+            ts, data = entry
+            if ts >= time.time():
+                return data
+            if time.time() - ts <= self.stale_while_revalidate:
+                self._refresh(name)
+                return data
+        return self._load(name)
+
+    def __delattr__(self, name):
+        if not self._remove(name):
+            raise AttributeError(name)
+
+
+if __name__ == '__main__':
+    loads = multiprocessing.Value('i', 0)
+
+    class TestSharedLocalCache(SharedLocalCache):
+        cache_time = 5
+
+        def get_data(self, name):
+            with loads.get_lock():
+                loads.value += 1
+            return {'name': name, 'loaded_by': os.getpid()}
+
+    test_cache = TestSharedLocalCache()
+    for i in range(10):
+        test_cache[i]
+
+    def worker():
+        for i in range(20):
+            test_cache[i]
+
+    workers = [multiprocessing.Process(target=worker) for _ in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    # 20, a few more when workers miss the same name at the same time
+    print 'loads by 5 processes reading 20 names:', loads.value
+    print sorted(name for name, _ in test_cache)